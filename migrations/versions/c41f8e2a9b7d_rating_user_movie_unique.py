@@ -0,0 +1,48 @@
+"""rating user movie unique
+
+Revision ID: c41f8e2a9b7d
+Revises: 6a3f4553ce1f
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+import sqlmodel
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41f8e2a9b7d'
+down_revision: Union[str, None] = '6a3f4553ce1f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # keep only the latest rating of each user and movie
+    op.execute("""
+        DELETE FROM rating
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (
+                    PARTITION BY user_id, movie_id ORDER BY id DESC
+                ) AS position
+                FROM rating
+            ) AS ranked
+            WHERE position > 1
+        )
+    """)
+    # built without locking writes, so it runs outside the transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_rating_user_id_movie_id', 'rating',
+                        ['user_id', 'movie_id'], unique=True,
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_rating_user_id_movie_id', table_name='rating',
+                      postgresql_concurrently=True, if_exists=True)
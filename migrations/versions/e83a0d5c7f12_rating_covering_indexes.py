@@ -0,0 +1,47 @@
+"""rating covering indexes
+
+Revision ID: e83a0d5c7f12
+Revises: c41f8e2a9b7d
+Create Date: 2026-10-18 14:37:05.902611
+
+"""
+from typing import Sequence, Union
+
+import sqlmodel
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e83a0d5c7f12'
+down_revision: Union[str, None] = 'c41f8e2a9b7d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # built without locking writes, so they run outside the transaction; the
+    # covering unique index replaces the plain one only once it is ready
+    with op.get_context().autocommit_block():
+        op.create_index('ix_rating_user_id_movie_id_rating', 'rating',
+                        ['user_id', 'movie_id'], unique=True,
+                        postgresql_include=['rating'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_rating_user_id_movie_id', table_name='rating',
+                      postgresql_concurrently=True, if_exists=True)
+        op.create_index('ix_rating_movie_id', 'rating', ['movie_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_rating_movie_id', table_name='rating',
+                      postgresql_concurrently=True, if_exists=True)
+        op.create_index('ix_rating_user_id_movie_id', 'rating',
+                        ['user_id', 'movie_id'], unique=True,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_rating_user_id_movie_id_rating',
+                      table_name='rating', postgresql_concurrently=True,
+                      if_exists=True)
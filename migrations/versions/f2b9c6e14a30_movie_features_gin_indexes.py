@@ -0,0 +1,40 @@
+"""movie features gin indexes
+
+Revision ID: f2b9c6e14a30
+Revises: e83a0d5c7f12
+Create Date: 2026-10-18 16:52:19.447830
+
+"""
+from typing import Sequence, Union
+
+import sqlmodel
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2b9c6e14a30'
+down_revision: Union[str, None] = 'e83a0d5c7f12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+FEATURE_COLUMNS = ('genres', 'actors', 'directors')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # built without locking writes, so they run outside the transaction
+    with op.get_context().autocommit_block():
+        for column in FEATURE_COLUMNS:
+            op.create_index(f'ix_movie_{column}', 'movie', [column],
+                            postgresql_using='gin',
+                            postgresql_concurrently=True,
+                            if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for column in FEATURE_COLUMNS:
+            op.drop_index(f'ix_movie_{column}', table_name='movie',
+                          postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, Protocol
+
+from recsys.common.database import redis_connection
+
+logger = logging.getLogger(__name__)
+
+
+def jittered_ttl(ttl: int, jitter: float) -> int:
+    # spreads the expiry of entries written together, e.g. by a batch job
+    return max(1, round(ttl * random.uniform(1 - jitter, 1 + jitter)))
+
+
+class Invalidated(Protocol):
+    def delete(self, key: Hashable): ...
+
+    def clear(self): ...
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: dict[Hashable, asyncio.Task] = {}
+
+    def run(
+        self,
+        key: Hashable,
+        function: Callable[[], Awaitable[Any]]
+    ) -> asyncio.Task:
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.create_task(function())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        return task
+
+    async def wait(
+        self,
+        key: Hashable,
+        function: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        # a cancelled caller must not cancel the flight other callers share
+        return await asyncio.shield(self.run(key, function))
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Flight {key} failed", exc_info=task.exception())
+
+
+async def publish_invalidation(channel: str, key: Hashable):
+    async with redis_connection() as conn:
+        await conn.publish(channel, key)
+
+
+async def subscribe_invalidations(
+    caches: dict[str, tuple[Invalidated, Callable[[str], Hashable]]]
+):
+    async with redis_connection() as conn, conn.pubsub() as pubsub:
+        await pubsub.subscribe(*caches)
+        # anything published while unsubscribed was missed
+        for cache, _ in caches.values():
+            cache.clear()
+
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                cache, parse_key = caches[message["channel"]]
+                cache.delete(parse_key(message["data"]))
+
+
+async def listen_invalidations(
+    caches: dict[str, tuple[Invalidated, Callable[[str], Hashable]]]
+):
+    while True:
+        try:
+            await subscribe_invalidations(caches)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Cache invalidations listener failed")
+            for cache, _ in caches.values():
+                cache.clear()
+            await asyncio.sleep(1)
@@ -1,36 +1,152 @@
+import asyncio
 import os
-from contextlib import asynccontextmanager, contextmanager
+import time
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
-from redis import Redis
-from sqlalchemy.ext.asyncio import create_async_engine
+from fastapi import HTTPException, status
+from redis.asyncio import BlockingConnectionPool, Redis
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from recsys.common import metrics
+
 load_dotenv()
-engine = create_async_engine(os.getenv("POSTGRES_URL"))
+
+
+class PostgresClient:
+    def __init__(self):
+        self._engine: AsyncEngine | None = None
+        self._sessions: sessionmaker | None = None
+        self._bulkhead: asyncio.Semaphore | None = None
+        self._timeout = 0.0
+
+    def open(self) -> AsyncEngine:
+        if self._engine is None:
+            pool_size = int(os.getenv("POSTGRES_POOL_SIZE", "10"))
+            max_overflow = int(os.getenv("POSTGRES_MAX_OVERFLOW", "10"))
+            self._timeout = float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))
+            self._engine = create_async_engine(
+                os.getenv("POSTGRES_URL"),
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=self._timeout,
+                pool_recycle=int(os.getenv("POSTGRES_POOL_RECYCLE", "1800")),
+                # connections dropped by the server are replaced before use
+                pool_pre_ping=True,
+                connect_args={
+                    "statement_cache_size": int(
+                        os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "100")
+                    ),
+                },
+            )
+            self._sessions = sessionmaker(
+                self._engine, class_=AsyncSession, expire_on_commit=False
+            )
+            # requests beyond the pool wait here, not inside the pool
+            self._bulkhead = asyncio.Semaphore(int(os.getenv(
+                "POSTGRES_MAX_CONCURRENCY", str(pool_size + max_overflow)
+            )))
+
+        return self._engine
+
+    @asynccontextmanager
+    async def session(self) -> AsyncSession:
+        self.open()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._bulkhead.acquire(), self._timeout)
+        except TimeoutError:
+            raise_exhausted("bulkhead")
+
+        try:
+            async with self._sessions() as session:
+                try:
+                    await session.connection()
+                except PoolTimeoutError:
+                    raise_exhausted("pool")
+                metrics.observe("recsys_db_checkout_seconds",
+                                time.perf_counter() - started)
+
+                yield session
+        finally:
+            self._bulkhead.release()
+
+    async def close(self):
+        if self._engine is not None:
+            engine, self._engine = self._engine, None
+            self._sessions = self._bulkhead = None
+            await engine.dispose()
+
+
+def raise_exhausted(stage: str):
+    metrics.increment("recsys_db_pool_exhausted_total", stage=stage)
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Database is busy, try again later",
+        headers={"Retry-After": "1"}
+    )
+
+
+postgres_client = PostgresClient()
 
 
 def create_db():
-    SQLModel.metadata.create_all(engine)
+    SQLModel.metadata.create_all(postgres_client.open())
 
 
-@contextmanager
-def redis_connection():
-    with Redis(host=os.getenv("REDIS_HOST"),
-               port=int(os.getenv("REDIS_PORT")),
-               password=os.getenv("REDIS_PASSWORD"),
-               decode_responses=True) as r:
-        yield r
+class RedisClient:
+    def __init__(self, decode_responses: bool = True):
+        self.decode_responses = decode_responses
+        self._client: Redis | None = None
+
+    def open(self) -> Redis:
+        if self._client is None:
+            # callers wait for a free connection instead of opening new ones
+            pool = BlockingConnectionPool(
+                host=os.getenv("REDIS_HOST"),
+                port=int(os.getenv("REDIS_PORT")),
+                password=os.getenv("REDIS_PASSWORD"),
+                decode_responses=self.decode_responses,
+                max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
+                timeout=float(os.getenv("REDIS_POOL_TIMEOUT", "5")),
+            )
+            self._client = Redis(connection_pool=pool)
+
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+            await client.connection_pool.disconnect()
+
+
+redis_client = RedisClient()
+# packed values such as cached recommendations must not be decoded
+binary_redis_client = RedisClient(decode_responses=False)
+
+
+async def close_redis():
+    await redis_client.close()
+    await binary_redis_client.close()
+
+
+@asynccontextmanager
+async def redis_connection(binary: bool = False) -> Redis:
+    yield (binary_redis_client if binary else redis_client).open()
+
+
+async def close_postgres():
+    await postgres_client.close()
 
 
 @asynccontextmanager
 async def postgres_connect() -> AsyncSession:
-    async_session = sessionmaker(
-        engine, class_=AsyncSession, expire_on_commit=False
-    )
-    async with async_session() as session:
+    async with postgres_client.session() as session:
         yield session
 
 
@@ -0,0 +1,25 @@
+from collections import Counter
+
+counters: Counter[tuple[str, tuple[tuple[str, str], ...]]] = Counter()
+
+
+def increment(name: str, value: float = 1, **labels: str):
+    counters[name, tuple(sorted(labels.items()))] += value
+
+
+def observe(name: str, value: float, **labels: str):
+    # exported as a summary without quantiles
+    increment(f"{name}_sum", value, **labels)
+    increment(f"{name}_count", **labels)
+
+
+def render() -> str:
+    lines = []
+    for (name, labels), value in sorted(counters.items()):
+        if labels:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{name}{{{label_text}}} {value}")
+        else:
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,58 @@
+import base64
+import binascii
+from dataclasses import dataclass
+
+from fastapi import HTTPException, Response, status
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(after_id: int) -> str:
+    cursor = base64.urlsafe_b64encode(f"id:{after_id}".encode())
+    return cursor.decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        decoded = base64.urlsafe_b64decode(cursor + padding).decode()
+        kind, _, after_id = decoded.partition(":")
+        if kind == "id":
+            return int(after_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        pass
+
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Invalid cursor")
+
+
+@dataclass(frozen=True)
+class Page:
+    skip: int
+    limit: int
+    after_id: int | None
+
+
+def page_params(
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None
+) -> Page:
+    after_id = decode_cursor(cursor) if cursor is not None else None
+    return Page(skip=skip, limit=limit, after_id=after_id)
+
+
+def paginate(query, id_column, skip: int, limit: int,
+             after_id: int | None):
+    # keyset pages seek on the primary key, so deep pages cost as much as
+    # the first one and inserts do not shift them
+    query = query.order_by(id_column).limit(limit)
+    if after_id is not None:
+        return query.where(id_column > after_id)
+
+    return query.offset(skip)
+
+
+def set_next_cursor(response: Response, items: list, limit: int):
+    if items and len(items) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(items[-1].id)
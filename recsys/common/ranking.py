@@ -0,0 +1,33 @@
+import numpy as np
+
+
+def top_k(
+    scores: np.ndarray,
+    ids: np.ndarray,
+    k: int,
+    excluded: np.ndarray | None = None
+) -> np.ndarray:
+    valid = ~np.isnan(scores)
+    if excluded is not None:
+        valid &= ~excluded
+
+    candidates = np.flatnonzero(valid)
+    if k <= 0 or not candidates.size:
+        return np.empty(0, dtype=np.int64)
+
+    candidate_scores = scores[candidates]
+
+    if k < candidates.size:
+        # the k-th highest score splits the candidates into the ones that
+        # surely stay and the tied ones, which are kept by lowest id
+        kth = candidates.size - k
+        threshold = np.partition(candidate_scores, kth)[kth]
+        above = np.flatnonzero(candidate_scores > threshold)
+        tied = np.flatnonzero(candidate_scores == threshold)
+        tied = tied[np.argsort(ids[candidates[tied]], kind="stable")]
+
+        keep = np.concatenate([above, tied[:k - above.size]])
+        candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+
+    order = np.lexsort((ids[candidates], -candidate_scores))
+    return candidates[order]
@@ -1,26 +1,107 @@
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import cache
 from zoneinfo import ZoneInfo
 
 import bcrypt
 from fastapi import HTTPException, status
 from jwt import encode
 
+from recsys.common import metrics
 
-def create_access_token(data: dict[str, str]):
+
+@dataclass(frozen=True)
+class TokenSettings:
+    secret_key: str
+    algorithm: str
+    expire_minutes: int
+
+
+@cache
+def token_settings() -> TokenSettings:
+    return TokenSettings(
+        secret_key=os.getenv("SECRET_KEY"),
+        algorithm=os.getenv("ALGORITHM"),
+        expire_minutes=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")),
+    )
+
+
+def create_access_token(data: dict[str, str | int]):
+    settings = token_settings()
     to_encode = data.copy()
     expire = datetime.now(tz=ZoneInfo("UTC")) + timedelta(
-        minutes=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+        minutes=settings.expire_minutes
     )
     to_encode.update({"exp": expire})
-    encoded_jwt = encode(to_encode, os.getenv("SECRET_KEY"),
-                         algorithm=os.getenv("ALGORITHM"))
+    encoded_jwt = encode(to_encode, settings.secret_key,
+                         algorithm=settings.algorithm)
 
     return encoded_jwt
 
 
+@dataclass(frozen=True)
+class PasswordSettings:
+    rounds: int
+    workers: int
+    queue_limit: int
+
+
+@cache
+def password_settings() -> PasswordSettings:
+    return PasswordSettings(
+        rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+        workers=int(os.getenv("PASSWORD_WORKERS", "2")),
+        queue_limit=int(os.getenv("PASSWORD_QUEUE_LIMIT", "32")),
+    )
+
+
+class PasswordPool:
+    def __init__(self):
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending = 0
+
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=password_settings().workers,
+                thread_name_prefix="password"
+            )
+
+        return self._executor
+
+    async def run(self, function, *args):
+        # bcrypt is slow on purpose, so a login storm is turned away
+        # instead of queueing up behind it
+        if self._pending >= password_settings().queue_limit:
+            metrics.increment("recsys_password_rejected_total")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many password checks, try again later",
+                headers={"Retry-After": "1"}
+            )
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor(), function,
+                                              *args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_pool = PasswordPool()
+
+
 def get_password_hash(password: str) -> str:
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=password_settings().rounds)
     hashed_password = bcrypt.hashpw(password.encode("utf-8"), salt)
     return hashed_password.decode("utf-8")
 
@@ -30,6 +111,15 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
                           hashed_password.encode("utf-8"))
 
 
+async def hash_password(password: str) -> str:
+    return await password_pool.run(get_password_hash, password)
+
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_pool.run(verify_password, plain_password,
+                                   hashed_password)
+
+
 def validate_user_authorization(current_user_id: int, req_user_id: int):
     if current_user_id != req_user_id:
         raise HTTPException(
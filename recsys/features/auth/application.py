@@ -6,12 +6,40 @@ from fastapi.security import OAuth2PasswordBearer
 from jwt import DecodeError, ExpiredSignatureError, decode
 
 from recsys.common import security
+from recsys.common.cache import LRUCache, publish_invalidation
 from recsys.features.auth.model import Auth
 from recsys.features.users.model import User
 from recsys.features.users.repository import get_user_by_email
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
+PRINCIPALS_CHANNEL = "principals:invalidate"
+
+# authenticated users by token subject, so most requests skip Postgres
+principals = LRUCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("AUTH_CACHE_TIME", "30")),
+)
+
+
+def token_claims(user: User) -> dict[str, str | int]:
+    return {"sub": user.email, "uid": user.id, "name": user.name}
+
+
+async def get_principal(subject: str) -> User | None:
+    user = principals.get(subject)
+    if user is None:
+        user = await get_user_by_email(subject)
+        if user:
+            principals.set(subject, user)
+
+    return user
+
+
+async def invalidate_principal(subject: str):
+    principals.delete(subject)
+    await publish_invalidation(PRINCIPALS_CHANNEL, subject)
+
 
 async def get_current_user(
     token: Annotated[str, Depends(oauth2_scheme)]
@@ -22,9 +50,10 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"}
     )
 
+    settings = security.token_settings()
     try:
-        payload = decode(token, os.getenv("SECRET_KEY"),
-                         algorithms=os.getenv("ALGORITHM"))
+        payload = decode(token, settings.secret_key,
+                         algorithms=[settings.algorithm])
         subject = payload.get("sub")
 
         if not subject:
@@ -32,9 +61,11 @@ async def get_current_user(
     except (ExpiredSignatureError, DecodeError):
         raise credentials_exception
 
-    user = await get_user_by_email(subject)
+    user = await get_principal(subject)
 
-    if not user:
+    # a token issued to a deleted user must not work for a new user
+    # registered with the same email
+    if not user or payload.get("uid", user.id) != user.id:
         raise credentials_exception
 
     return user
@@ -48,12 +79,13 @@ async def create_access_token(auth_req: Auth) -> str:
             detail="Incorrect email or password"
         )
 
-    if not security.verify_password(auth_req.password, user.password):
+    if not await security.check_password(auth_req.password,
+                                         user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
         )
 
-    access_token = security.create_access_token(data={"sub": user.email})
+    access_token = security.create_access_token(data=token_claims(user))
 
     return access_token
@@ -6,6 +6,7 @@ from recsys.common import security
 from recsys.features.auth.application import (
     create_access_token,
     get_current_user,
+    token_claims,
 )
 from recsys.features.auth.model import Auth, Token
 from recsys.features.users.model import User
@@ -27,6 +28,6 @@ async def refresh_access_token(
     current_user: Annotated[User, Depends(get_current_user)]
 ) -> Token:
     new_access_token = security.create_access_token(
-        {"sub": current_user.email}
+        token_claims(current_user)
     )
     return {"access_token": new_access_token, "token_type": "bearer"}
@@ -1,14 +1,42 @@
 
+import csv
+import io
+import json
+import os
+from collections.abc import AsyncIterator, Iterable
+
 from fastapi import HTTPException, status
+from sqlalchemy.exc import IntegrityError
 
 from recsys.features.movies import repository
+from recsys.features.movies.catalog import (
+    catalog_loader,
+    get_catalog,
+    invalidate_catalog,
+)
 from recsys.features.movies.model import (
     Movie,
     MovieBase,
+    MovieFilter,
     MoviePublic,
     MovieUpdate,
 )
-from recsys.features.ratings.model import RatingBase, RatingPublic
+from recsys.features.ratings.buffer import rating_buffer
+from recsys.features.ratings.model import (
+    MAX_RATING,
+    MIN_RATING,
+    RatingBase,
+    RatingPublic,
+    RatingQueued,
+)
+from recsys.features.users import profile
+from recsys.features.users.repository import (
+    bump_profile_version,
+    delete_recommendations,
+)
+
+EXPORT_FIELDS = ("id", "title", "genres", "actors", "directors")
+LIST_FIELDS = ("genres", "actors", "directors")
 
 
 async def get_movie(movie_id: int) -> Movie:
@@ -22,24 +50,101 @@ async def get_movie(movie_id: int) -> Movie:
     return movie
 
 
-async def get_movies(skip: int, limit: int):
-    movies = await repository.get_movies(skip, limit)
+async def get_movies_by_ids(movie_ids: list[int]) -> list[Movie]:
+    movies = {}
+
+    # an outdated catalog would serve edited or deleted movies
+    catalog = catalog_loader.current()
+    if catalog is not None:
+        movies = {
+            movie_id: catalog.movie(movie_id)
+            for movie_id in movie_ids if catalog.row(movie_id) is not None
+        }
+
+    missing_ids = [
+        movie_id for movie_id in movie_ids if movie_id not in movies
+    ]
+    if missing_ids:
+        for movie in await repository.get_movies_by_ids(missing_ids):
+            movies[movie.id] = movie
+
+    return [movies[movie_id] for movie_id in movie_ids if movie_id in movies]
+
+
+async def get_similar_movies(movie_id: int) -> list[Movie]:
+    similar_ids = await repository.get_similar_movies(movie_id)
+    if similar_ids is None:
+        # movies added after the last neighbor table build have no entry yet
+        await get_movie(movie_id)
+        return []
+
+    await get_catalog()
+    return await get_movies_by_ids(similar_ids)
+
+
+async def get_movies(skip: int, limit: int, after_id: int | None = None,
+                     filters: MovieFilter | None = None):
+    movies = await repository.get_movies(skip, limit, after_id, filters)
     return movies
 
 
+def movies_to_ndjson(movies: Iterable[Movie]) -> str:
+    return "".join(
+        json.dumps({field: getattr(movie, field) for field in EXPORT_FIELDS},
+                   ensure_ascii=False) + "\n"
+        for movie in movies
+    )
+
+
+def movies_to_csv(movies: Iterable[Movie], header: bool = False) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+
+    for movie in movies:
+        # lists are written as arrays scripts/load_movies.py can read back
+        writer.writerow([movie.id, movie.title] + [
+            "" if getattr(movie, field) is None
+            else json.dumps(getattr(movie, field), ensure_ascii=False)
+            for field in LIST_FIELDS
+        ])
+
+    return buffer.getvalue()
+
+
+async def export_movies(export_format: str) -> AsyncIterator[str]:
+    batch_size = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+    header = export_format == "csv"
+
+    async for movies in repository.stream_movies(batch_size):
+        if export_format == "csv":
+            yield movies_to_csv(movies, header)
+            header = False
+        else:
+            yield movies_to_ndjson(movies)
+
+    if header:
+        yield movies_to_csv([], header)
+
+
 async def create_movie(movie: MovieBase) -> MoviePublic:
     created_movie = await repository.create_movie(movie)
+    await invalidate_catalog()
     return created_movie
 
 
 async def update_movie(movie_id: int, movie: MovieUpdate):
     movie_db = await get_movie(movie_id)
     updated_movie = await repository.update_movie(movie_db, movie)
+    await invalidate_catalog()
     return updated_movie
 
 
 async def delete_movie(movie_id: int):
     await repository.delete_movie(movie_id)
+    await repository.delete_similar_movies(movie_id)
+    await invalidate_catalog()
 
 
 async def get_movie_ratings(movie_id: int) -> list[RatingPublic]:
@@ -47,15 +152,47 @@ async def get_movie_ratings(movie_id: int) -> list[RatingPublic]:
     return ratings
 
 
+async def queue_movie_rating(
+    movie_id: int, user_id: int, rating: RatingBase
+) -> RatingQueued:
+    # a current catalog spares a query for all but brand new movies
+    catalog = catalog_loader.current()
+    if catalog is None or catalog.row(movie_id) is None:
+        await get_movie(movie_id)
+
+    await rating_buffer.put(user_id, movie_id, rating.rating)
+    return RatingQueued(user_id=user_id, movie_id=movie_id,
+                        rating=rating.rating)
+
+
 async def create_movie_rating(
     movie_id: int, user_id: int, rating: RatingBase
-) -> RatingPublic:
-    if not (0 <= rating.rating <= 5):
+) -> RatingPublic | RatingQueued:
+    if not (MIN_RATING <= rating.rating <= MAX_RATING):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Rating must be between 0 and 5"
+            detail=f"Rating must be between {MIN_RATING} and {MAX_RATING}"
         )
+    if rating_buffer.enabled:
+        return await queue_movie_rating(movie_id, user_id, rating)
+
     movie = await get_movie(movie_id)
+    version = await bump_profile_version(user_id)
     created_rating = await repository.create_movie_rating(movie, user_id,
                                                           rating)
+
+    if isinstance(created_rating, IntegrityError):
+        if getattr(created_rating.orig, "pgcode") == "23505":
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Movie already rated"
+            )
+
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+    await profile.apply_rating(user_id, movie.id, created_rating.rating,
+                               version)
+    await delete_recommendations(user_id)
     return created_rating
@@ -0,0 +1,471 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from bisect import bisect_left
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from datetime import datetime
+from uuid import uuid4
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+from recsys.common.cache import SingleFlight
+from recsys.features.movies.model import Movie
+from recsys.features.movies.repository import (
+    bump_catalog_generation,
+    get_all_movies,
+    get_catalog_generation,
+    lock_catalog_snapshot,
+    unlock_catalog_snapshot,
+)
+
+logger = logging.getLogger(__name__)
+
+GENRE = 0
+ACTOR = 1
+DIRECTOR = 2
+
+FEATURE_KINDS = (
+    ("genres", GENRE),
+    ("actors", ACTOR),
+    ("directors", DIRECTOR),
+)
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_POINTER = "CURRENT"
+SNAPSHOT_KEEP = 2
+# seconds before asking again for the lock another worker holds while
+# writing the next snapshot
+SNAPSHOT_RETRY_TIME = float(os.getenv("CATALOG_SNAPSHOT_RETRY_TIME", "10"))
+
+KIND_LABELS = {GENRE: "genre", ACTOR: "actor", DIRECTOR: "director"}
+LABEL_KINDS = {label: kind for kind, label in KIND_LABELS.items()}
+
+
+def feature_label(kind: int, name: str) -> str:
+    return f"{KIND_LABELS[kind]}:{name}"
+
+
+def parse_feature_label(label: str) -> tuple[int, str] | None:
+    kind_label, _, name = label.partition(":")
+    kind = LABEL_KINDS.get(kind_label)
+    if kind is None:
+        return None
+
+    return kind, name
+
+
+class StringTable(Sequence[str]):
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self._buffer = memoryview(blob)
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> "StringTable":
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return str(self.encoded(index), "utf-8")
+
+    def encoded(self, index: int) -> memoryview:
+        return self._buffer[self.offsets[index]:self.offsets[index + 1]]
+
+
+@dataclass
+class Catalog:
+    movie_ids: np.ndarray
+    titles: Sequence[str]
+    features: Sequence[str]
+    feature_kinds: np.ndarray
+    matrix: csr_matrix
+    movies_by_feature: csc_matrix
+    id_order: np.ndarray
+    feature_order: np.ndarray
+    version: str | None = None
+    path: str | None = None
+    # catalog generation in Redis when its movies were read
+    generation: int | None = None
+
+    def __post_init__(self):
+        self.postings = np.diff(self.movies_by_feature.indptr)
+
+    def __len__(self) -> int:
+        return len(self.movie_ids)
+
+    def __reduce__(self):
+        if self.path is None:
+            return super().__reduce__()
+
+        # snapshot catalogs are reopened instead of copied between processes
+        return load_catalog, (self.path,)
+
+    def rows_of(self, movie_ids: Iterable[int]) -> np.ndarray:
+        movie_ids = np.fromiter(movie_ids, dtype=np.int64)
+        if not len(self):
+            return np.full(movie_ids.size, -1, dtype=np.int64)
+
+        positions = np.searchsorted(self.movie_ids, movie_ids,
+                                    sorter=self.id_order)
+        rows = self.id_order[np.minimum(positions, len(self) - 1)]
+
+        return np.where(self.movie_ids[rows] == movie_ids, rows, -1)
+
+    def row(self, movie_id: int) -> int | None:
+        position = int(np.searchsorted(self.movie_ids, movie_id,
+                                       sorter=self.id_order))
+        if position == len(self):
+            return None
+
+        row = int(self.id_order[position])
+        return row if self.movie_ids[row] == movie_id else None
+
+    def column(self, kind: int, name: str) -> int | None:
+        position = bisect_left(
+            self.feature_order, (kind, name),
+            key=lambda column: (self.feature_kinds[column],
+                                self.features[column])
+        )
+        if position == len(self.feature_order):
+            return None
+
+        column = int(self.feature_order[position])
+        if (self.feature_kinds[column], self.features[column]) != (kind, name):
+            return None
+
+        return column
+
+    def label(self, column: int) -> str:
+        return feature_label(int(self.feature_kinds[column]),
+                             self.features[column])
+
+    def columns_of(self, movie_id: int) -> np.ndarray:
+        row = self.row(movie_id)
+        return self.matrix.indices[
+            self.matrix.indptr[row]:self.matrix.indptr[row + 1]
+        ]
+
+    def postings_size(self, columns: np.ndarray) -> int:
+        return int(self.postings[columns].sum())
+
+    def rows_with(self, columns: np.ndarray) -> np.ndarray:
+        indptr = self.movies_by_feature.indptr
+        rows = [
+            self.movies_by_feature.indices[indptr[column]:indptr[column + 1]]
+            for column in columns.tolist()
+        ]
+        if not rows:
+            return np.empty(0, dtype=np.int64)
+
+        return np.unique(np.concatenate(rows))
+
+    def movie(self, movie_id: int) -> Movie:
+        values = {kind: [] for _, kind in FEATURE_KINDS}
+        columns = self.columns_of(movie_id)
+        for column, kind in zip(columns.tolist(),
+                                self.feature_kinds[columns].tolist()):
+            values[kind].append(self.features[column])
+
+        return Movie(
+            id=movie_id,
+            title=self.titles[self.row(movie_id)],
+            genres=values[GENRE],
+            actors=values[ACTOR] or None,
+            directors=values[DIRECTOR] or None,
+        )
+
+    def feature_mask(
+        self,
+        favorite_actors: Iterable[str],
+        favorite_directors: Iterable[str]
+    ) -> np.ndarray:
+        mask = self.feature_kinds == GENRE
+
+        for kind, favorites in ((ACTOR, favorite_actors),
+                                (DIRECTOR, favorite_directors)):
+            for name in favorites:
+                column = self.column(kind, name)
+                if column is not None:
+                    mask[column] = True
+
+        return mask
+
+
+def build_catalog(movies: list[Movie]) -> Catalog:
+    columns: dict[tuple[int, str], int] = {}
+    features: list[str] = []
+    feature_kinds: list[int] = []
+    indptr = [0]
+    indices: list[int] = []
+
+    for movie in movies:
+        movie_columns: dict[int, None] = {}
+        for attribute, kind in FEATURE_KINDS:
+            for value in getattr(movie, attribute) or []:
+                key = (kind, value.strip())
+                column = columns.get(key)
+                if column is None:
+                    column = columns[key] = len(features)
+                    features.append(key[1])
+                    feature_kinds.append(kind)
+                movie_columns[column] = None
+
+        indices.extend(movie_columns)
+        indptr.append(len(indices))
+
+    matrix = csr_matrix(
+        (
+            np.ones(len(indices)),
+            np.array(indices, dtype=np.int32),
+            np.array(indptr, dtype=np.int32),
+        ),
+        shape=(len(movies), len(features))
+    )
+    movie_ids = np.array([movie.id for movie in movies], dtype=np.int64)
+
+    return Catalog(
+        movie_ids=movie_ids,
+        titles=[movie.title for movie in movies],
+        features=features,
+        feature_kinds=np.array(feature_kinds, dtype=np.int8),
+        matrix=matrix,
+        movies_by_feature=matrix.tocsc(),
+        id_order=np.argsort(movie_ids, kind="stable"),
+        feature_order=np.array(sorted(columns.values(),
+                                      key=lambda column: (
+                                          feature_kinds[column],
+                                          features[column]
+                                      )),
+                               dtype=np.int32),
+    )
+
+
+def save_catalog(catalog: Catalog, root: str) -> str:
+    version = datetime.now(tz=ZoneInfo("UTC")).strftime("%Y%m%dT%H%M%S%f")
+    path = os.path.join(root, version)
+    os.makedirs(path)
+
+    titles = StringTable.from_strings(catalog.titles)
+    features = StringTable.from_strings(catalog.features)
+    arrays = {
+        "movie_ids": catalog.movie_ids,
+        "titles_blob": titles.blob,
+        "titles_offsets": titles.offsets,
+        "features_blob": features.blob,
+        "features_offsets": features.offsets,
+        "feature_kinds": catalog.feature_kinds,
+        "id_order": catalog.id_order,
+        "feature_order": catalog.feature_order,
+        "matrix_data": catalog.matrix.data,
+        "matrix_indices": catalog.matrix.indices,
+        "matrix_indptr": catalog.matrix.indptr,
+        "inverted_data": catalog.movies_by_feature.data,
+        "inverted_indices": catalog.movies_by_feature.indices,
+        "inverted_indptr": catalog.movies_by_feature.indptr,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+    with open(os.path.join(path, "manifest.json"), "w",
+              encoding="utf-8") as manifest:
+        json.dump({
+            "format": SNAPSHOT_FORMAT,
+            "version": version,
+            "movies": len(catalog),
+            "features": len(catalog.features),
+            "nnz": int(catalog.matrix.nnz),
+            "generation": catalog.generation,
+        }, manifest)
+
+    # the pointer is swapped atomically so readers never see a half snapshot
+    pointer = os.path.join(root, f"{SNAPSHOT_POINTER}.{version}")
+    with open(pointer, "w", encoding="utf-8") as current:
+        current.write(version)
+    os.replace(pointer, os.path.join(root, SNAPSHOT_POINTER))
+
+    return version
+
+
+def current_snapshot(root: str) -> str | None:
+    try:
+        with open(os.path.join(root, SNAPSHOT_POINTER),
+                  encoding="utf-8") as current:
+            return os.path.join(root, current.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def load_catalog(path: str) -> Catalog:
+    with open(os.path.join(path, "manifest.json"),
+              encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest["format"] != SNAPSHOT_FORMAT:
+        raise ValueError(
+            f"Unsupported catalog snapshot format {manifest['format']}"
+        )
+
+    def array(name: str) -> np.ndarray:
+        # plain views over the mapping skip np.memmap's indexing overhead
+        return np.asarray(np.load(os.path.join(path, f"{name}.npy"),
+                                  mmap_mode="r"))
+
+    shape = (manifest["movies"], manifest["features"])
+    matrix = csr_matrix(
+        (array("matrix_data"), array("matrix_indices"),
+         array("matrix_indptr")),
+        shape=shape, copy=False
+    )
+    movies_by_feature = csc_matrix(
+        (array("inverted_data"), array("inverted_indices"),
+         array("inverted_indptr")),
+        shape=shape, copy=False
+    )
+
+    return Catalog(
+        movie_ids=array("movie_ids"),
+        titles=StringTable(array("titles_blob"), array("titles_offsets")),
+        features=StringTable(array("features_blob"),
+                             array("features_offsets")),
+        feature_kinds=array("feature_kinds"),
+        matrix=matrix,
+        movies_by_feature=movies_by_feature,
+        id_order=array("id_order"),
+        feature_order=array("feature_order"),
+        version=manifest["version"],
+        path=path,
+        generation=manifest.get("generation"),
+    )
+
+
+def prune_snapshots(root: str, keep: int = SNAPSHOT_KEEP):
+    # workers still mapping a removed snapshot keep reading it until they
+    # switch to the current one
+    versions = sorted(
+        entry.name for entry in os.scandir(root)
+        if entry.is_dir() and entry.name != SNAPSHOT_POINTER
+    )
+    for version in versions[:-keep]:
+        shutil.rmtree(os.path.join(root, version))
+        logger.info(f"Snapshot {version} removed")
+
+
+async def read_catalog() -> Catalog:
+    # the generation is read first, so movies written after it only make
+    # the catalog look older than it is
+    generation = await get_catalog_generation()
+    movies = await get_all_movies()
+    catalog = await asyncio.to_thread(build_catalog, movies)
+    catalog.generation = generation
+
+    return catalog
+
+
+async def build_snapshot(root: str) -> str | None:
+    token = uuid4().hex
+    if not await lock_catalog_snapshot(token):
+        return None
+
+    try:
+        catalog = await read_catalog()
+        version = await asyncio.to_thread(save_catalog, catalog, root)
+        await asyncio.to_thread(prune_snapshots, root)
+    finally:
+        await unlock_catalog_snapshot(token)
+
+    logger.info(f"Snapshot {version} written with {len(catalog)} movies")
+    return version
+
+
+def is_current(catalog: Catalog | None, generation: int | None) -> bool:
+    return (catalog is not None and generation is not None
+            and catalog.generation is not None
+            and catalog.generation >= generation)
+
+
+class CatalogLoader:
+    def __init__(self):
+        self._catalog: Catalog | None = None
+        self._generation: int | None = None
+        self._lock = asyncio.Lock()
+        self._snapshots = SingleFlight()
+        self._snapshot_retry = 0.0
+
+    async def generation(self) -> int:
+        # kept up to date by the invalidations listener, read from Redis
+        # only when unknown
+        if self._generation is None:
+            self._generation = await get_catalog_generation()
+
+        return self._generation
+
+    async def get(self) -> Catalog:
+        generation = await self.generation()
+        snapshot_root = os.getenv("CATALOG_SNAPSHOT_DIR")
+        snapshot = current_snapshot(snapshot_root) if snapshot_root else None
+
+        if snapshot is not None:
+            if self._catalog is None or self._catalog.path != snapshot:
+                self._catalog = load_catalog(snapshot)
+        elif not is_current(self._catalog, generation):
+            async with self._lock:
+                if not is_current(self._catalog, generation):
+                    self._catalog = await read_catalog()
+
+        # an outdated snapshot is served until one worker writes the next
+        if (snapshot_root and time.monotonic() >= self._snapshot_retry
+                and (snapshot is None
+                     or not is_current(self._catalog, generation))):
+            self._snapshots.run(snapshot_root,
+                                lambda: self.build_snapshot(snapshot_root))
+
+        return self._catalog
+
+    async def build_snapshot(self, root: str) -> str | None:
+        version = None
+        try:
+            version = await build_snapshot(root)
+        finally:
+            # requests meanwhile skip the lock held by another worker
+            if version is None:
+                self._snapshot_retry = (time.monotonic()
+                                        + SNAPSHOT_RETRY_TIME)
+
+        return version
+
+    def current(self) -> Catalog | None:
+        if is_current(self._catalog, self._generation):
+            return self._catalog
+
+        return None
+
+    def delete(self, generation: int):
+        # a movie was written by this or another worker
+        self._generation = max(self._generation or 0, generation)
+
+    def clear(self):
+        # published generations may have been missed
+        self._generation = None
+
+
+catalog_loader = CatalogLoader()
+
+
+async def get_catalog() -> Catalog:
+    return await catalog_loader.get()
+
+
+async def invalidate_catalog():
+    catalog_loader.delete(await bump_catalog_generation())
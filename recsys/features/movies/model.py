@@ -1,6 +1,6 @@
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Literal
 
-from sqlalchemy import Column, String
+from sqlalchemy import Column, Index, String
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlmodel import Field, Relationship, SQLModel
 
@@ -16,6 +16,12 @@ class MovieBase(SQLModel):
 
 
 class Movie(MovieBase, table=True):
+    __table_args__ = (
+        Index("ix_movie_genres", "genres", postgresql_using="gin"),
+        Index("ix_movie_actors", "actors", postgresql_using="gin"),
+        Index("ix_movie_directors", "directors", postgresql_using="gin"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     genres: list[str] = Field(sa_column=Column(ARRAY(String)))
     actors: list[str] | None = Field(default=None,
@@ -30,8 +36,22 @@ class MoviePublic(MovieBase):
     id: int
 
 
+class MovieFilter(SQLModel):
+    genres: list[str] | None = None
+    actors: list[str] | None = None
+    directors: list[str] | None = None
+    # all of the given values, or any of them
+    match: Literal["all", "any"] = "all"
+
+
 class MovieUpdate(SQLModel):
     title: str | None = None
     genres: list[str] | None = None
     directors: list[str] | None = None
     actors: list[str] | None = None
+
+
+class MovieLoad(SQLModel, table=True):
+    # rows of a dataset already copied by scripts/load_movies.py
+    source: str = Field(primary_key=True)
+    loaded: int = 0
@@ -1,13 +1,27 @@
+import json
+import os
+from collections.abc import AsyncIterator, Sequence
+
+from sqlalchemy import Integer, Row, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import selectinload
 from sqlmodel import select
 
-from recsys.common.database import postgres_connect
+from recsys.common.database import postgres_connect, redis_connection
+from recsys.common.pagination import paginate
 from recsys.features.movies.model import (
     Movie,
     MovieBase,
+    MovieFilter,
     MovieUpdate,
 )
 from recsys.features.ratings.model import Rating, RatingBase
+from recsys.features.users.repository import UNLOCK_SCRIPT
+
+CATALOG_CHANNEL = "catalog:invalidate"
+CATALOG_GENERATION_KEY = "catalog:generation"
+CATALOG_SNAPSHOT_LOCK = "lock:catalog:snapshot"
 
 
 async def create_movie(movie: MovieBase) -> Movie:
@@ -19,9 +33,27 @@ async def create_movie(movie: MovieBase) -> Movie:
         return movie_db
 
 
-async def get_movies(skip: int, limit: int) -> list[Movie]:
+def filter_movies(query, filters: MovieFilter):
+    # @> and && are both served by the GIN indexes on the array columns
+    for column, values in ((Movie.genres, filters.genres),
+                           (Movie.actors, filters.actors),
+                           (Movie.directors, filters.directors)):
+        if values:
+            query = query.where(column.contains(values)
+                                if filters.match == "all"
+                                else column.overlap(values))
+
+    return query
+
+
+async def get_movies(skip: int, limit: int, after_id: int | None = None,
+                     filters: MovieFilter | None = None) -> list[Movie]:
     async with postgres_connect() as conn:
-        result = await conn.exec(select(Movie).offset(skip).limit(limit))
+        query = select(Movie)
+        if filters is not None:
+            query = filter_movies(query, filters)
+        query = paginate(query, Movie.id, skip, limit, after_id)
+        result = await conn.exec(query)
         movies = result.all()
 
         return movies
@@ -35,6 +67,17 @@ async def get_all_movies() -> list[Movie]:
         return movies
 
 
+async def stream_movies(batch_size: int) -> AsyncIterator[Sequence[Row]]:
+    async with postgres_connect() as conn:
+        # a server-side cursor keeps one batch in memory at a time
+        query = select(Movie.id, Movie.title, Movie.genres, Movie.actors,
+                       Movie.directors)\
+            .order_by(Movie.id).execution_options(yield_per=batch_size)
+        result = await conn.stream(query)
+        async for batch in result.partitions():
+            yield batch
+
+
 async def get_movie(movie_id: int) -> Movie | None:
     async with postgres_connect() as conn:
         movie = await conn.get(Movie, movie_id)
@@ -42,6 +85,15 @@ async def get_movie(movie_id: int) -> Movie | None:
         return movie
 
 
+async def get_movies_by_ids(movie_ids: list[int]) -> list[Movie]:
+    async with postgres_connect() as conn:
+        ids = bindparam("movie_ids", movie_ids, type_=ARRAY(Integer))
+        result = await conn.exec(select(Movie).where(Movie.id == any_(ids)))
+        movies = result.all()
+
+        return movies
+
+
 async def delete_movie(movie_id: int):
     async with postgres_connect() as conn:
         movie = await conn.get(Movie, movie_id)
@@ -62,15 +114,19 @@ async def update_movie(movie_db: Movie, new_movie: MovieUpdate) -> Movie:
 async def create_movie_rating(
     movie: Movie, user_id: int,
     rating: RatingBase
-) -> Rating:
+) -> Rating | IntegrityError:
     async with postgres_connect() as conn:
         rating_db = Rating.model_validate(rating)
         rating_db.movie_id = movie.id
         rating_db.user_id = user_id
-        conn.add(rating_db)
-        await conn.commit()
-        await conn.refresh(rating_db)
-        return rating_db
+        try:
+            conn.add(rating_db)
+            await conn.commit()
+            await conn.refresh(rating_db)
+            return rating_db
+        except IntegrityError as error:
+            await conn.rollback()
+            return error
 
 
 async def get_movie_ratings(movie_id: int):
@@ -81,3 +137,60 @@ async def get_movie_ratings(movie_id: int):
         movie = result.first()
 
         return movie.ratings
+
+
+def similar_movies_key(movie_id: int) -> str:
+    return f"similar:{movie_id}"
+
+
+async def get_similar_movies(movie_id: int) -> list[int] | None:
+    async with redis_connection() as conn:
+        result = await conn.get(similar_movies_key(movie_id))
+
+        if result is None:
+            return None
+
+        return json.loads(result)
+
+
+async def store_similar_movies(similar_movies: dict[int, list[int]]):
+    async with redis_connection() as conn:
+        pipeline = conn.pipeline(transaction=False)
+        for movie_id, similar_ids in similar_movies.items():
+            pipeline.set(similar_movies_key(movie_id), json.dumps(similar_ids))
+        await pipeline.execute()
+
+
+async def delete_similar_movies(movie_id: int):
+    async with redis_connection() as conn:
+        await conn.delete(similar_movies_key(movie_id))
+
+
+async def get_catalog_generation() -> int:
+    async with redis_connection() as conn:
+        generation = await conn.get(CATALOG_GENERATION_KEY)
+
+        return int(generation or 0)
+
+
+async def bump_catalog_generation() -> int:
+    async with redis_connection() as conn:
+        generation = await conn.incr(CATALOG_GENERATION_KEY)
+        await conn.publish(CATALOG_CHANNEL, generation)
+
+        return generation
+
+
+async def lock_catalog_snapshot(token: str) -> bool:
+    async with redis_connection() as conn:
+        return bool(await conn.set(
+            CATALOG_SNAPSHOT_LOCK, token, nx=True,
+            ex=int(os.getenv("CATALOG_SNAPSHOT_LOCK_TIME", "600"))
+        ))
+
+
+async def unlock_catalog_snapshot(token: str):
+    # a build that outlived its lock leaves the next owner's lock alone
+    async with redis_connection() as conn:
+        unlock = conn.register_script(UNLOCK_SCRIPT)
+        await unlock(keys=[CATALOG_SNAPSHOT_LOCK], args=[token])
@@ -1,15 +1,22 @@
-from typing import Annotated
+from typing import Annotated, Literal
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, Response, status
+from fastapi.responses import StreamingResponse
 
+from recsys.common.pagination import Page, page_params, set_next_cursor
 from recsys.features.auth.application import get_current_user
 from recsys.features.movies import application
 from recsys.features.movies.model import (
     MovieBase,
+    MovieFilter,
     MoviePublic,
     MovieUpdate,
 )
-from recsys.features.ratings.model import RatingBase, RatingPublic
+from recsys.features.ratings.model import (
+    RatingBase,
+    RatingPublic,
+    RatingQueued,
+)
 from recsys.features.users.model import User
 
 router = APIRouter(
@@ -17,16 +24,46 @@ router = APIRouter(
     tags=["movies"]
 )
 
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def movie_filter(
+    genre: Annotated[list[str] | None, Query()] = None,
+    actor: Annotated[list[str] | None, Query()] = None,
+    director: Annotated[list[str] | None, Query()] = None,
+    match: Literal["all", "any"] = "all"
+) -> MovieFilter:
+    return MovieFilter(genres=genre, actors=actor, directors=director,
+                       match=match)
+
 
 @router.get("/", status_code=status.HTTP_200_OK)
 async def get_movies(
     current_user: Annotated[User, Depends(get_current_user)],
-    skip: int = 0, limit: int = 100
+    response: Response,
+    page: Annotated[Page, Depends(page_params)],
+    filters: Annotated[MovieFilter, Depends(movie_filter)],
 ) -> list[MoviePublic]:
-    movies = await application.get_movies(skip, limit)
+    movies = await application.get_movies(page.skip, page.limit,
+                                          page.after_id, filters)
+    set_next_cursor(response, movies, page.limit)
     return movies
 
 
+@router.get("/export", status_code=status.HTTP_200_OK)
+async def export_movies(
+    current_user: Annotated[User, Depends(get_current_user)],
+    export_format: Annotated[Literal["ndjson", "csv"],
+                             Query(alias="format")] = "ndjson"
+) -> StreamingResponse:
+    return StreamingResponse(
+        application.export_movies(export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition":
+                 f"attachment; filename=movies.{export_format}"}
+    )
+
+
 @router.get("/{movie_id}", status_code=status.HTTP_200_OK)
 async def get_movie(
     movie_id: int,
@@ -36,6 +73,15 @@ async def get_movie(
     return movie
 
 
+@router.get("/{movie_id}/similar", status_code=status.HTTP_200_OK)
+async def get_similar_movies(
+    movie_id: int,
+    current_user: Annotated[User, Depends(get_current_user)]
+) -> list[MoviePublic]:
+    similar_movies = await application.get_similar_movies(movie_id)
+    return similar_movies
+
+
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def post_movie(
     movie: MovieBase,
@@ -75,10 +121,13 @@ async def get_movie_ratings(
 @router.post("/{movie_id}/ratings", status_code=status.HTTP_201_CREATED)
 async def post_movie_rating(
     movie_id: int, rating: RatingBase,
-    current_user: Annotated[User, Depends(get_current_user)]
-) -> RatingPublic:
+    current_user: Annotated[User, Depends(get_current_user)],
+    response: Response
+) -> RatingPublic | RatingQueued:
     created_rating = await application.create_movie_rating(
                                                      movie_id,
                                                      current_user.id, rating
                                                  )
+    if isinstance(created_rating, RatingQueued):
+        response.status_code = status.HTTP_202_ACCEPTED
     return created_rating
@@ -0,0 +1,51 @@
+from collections.abc import Iterator
+
+import numpy as np
+
+from recsys.common.ranking import top_k
+from recsys.features.movies.catalog import Catalog
+
+# movie pairs sharing a feature held at once at most, about 28 bytes each
+# between their overlaps, rows and scores
+SIMILAR_BLOCK_CELLS = 2 ** 22
+
+
+def similar_movies(
+    catalog: Catalog,
+    k: int,
+    block_cells: int = SIMILAR_BLOCK_CELLS
+) -> Iterator[dict[int, list[int]]]:
+    # cosine over the binary feature vectors is the shared genres, actors
+    # and directors over the geometric mean of both movies' feature counts
+    norms = np.sqrt(np.diff(catalog.matrix.indptr))
+    features_by_movie = catalog.movies_by_feature.T
+
+    # a movie overlaps at most the movies of each of its features, so
+    # blocks are cut on that bound and a genre shared by most of the
+    # catalog makes its blocks shorter instead of larger
+    pairs = np.minimum(catalog.matrix @ catalog.postings, len(catalog))
+    bounds = np.cumsum(pairs)
+
+    start = 0
+    while start < len(catalog):
+        held = bounds[start - 1] if start else 0
+        end = max(start + 1, int(np.searchsorted(bounds, held + block_cells,
+                                                 side="right")))
+        overlaps = (catalog.matrix[start:end] @ features_by_movie).tocsr()
+
+        block_rows = np.repeat(np.arange(start, end), np.diff(overlaps.indptr))
+        scores = overlaps.data / (norms[block_rows] * norms[overlaps.indices])
+
+        neighbors = {}
+        for position, row in enumerate(range(start, end)):
+            row_slice = slice(overlaps.indptr[position],
+                              overlaps.indptr[position + 1])
+            rows = overlaps.indices[row_slice]
+            top_rows = top_k(scores[row_slice], catalog.movie_ids[rows], k,
+                             excluded=rows == row)
+            neighbors[int(catalog.movie_ids[row])] = (
+                catalog.movie_ids[rows[top_rows]].tolist()
+            )
+
+        yield neighbors
+        start = end
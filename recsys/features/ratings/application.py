@@ -2,6 +2,10 @@ from fastapi import HTTPException, status
 
 from recsys.features.ratings import repository
 from recsys.features.ratings.model import Rating, RatingPublic, RatingUpdate
+from recsys.features.users.repository import (
+    delete_profile,
+    delete_recommendations,
+)
 
 
 async def get_rating(rating_id: int) -> Rating:
@@ -15,8 +19,12 @@ async def get_rating(rating_id: int) -> Rating:
     return rating
 
 
-async def get_ratings(skip: int, limit: int) -> list[RatingPublic]:
-    ratings = await repository.get_ratings()
+async def get_ratings(
+    skip: int,
+    limit: int,
+    after_id: int | None = None
+) -> list[RatingPublic]:
+    ratings = await repository.get_ratings(skip, limit, after_id)
     return ratings
 
 
@@ -25,8 +33,14 @@ async def update_rating(
     rating: RatingUpdate
 ) -> RatingPublic:
     updated_rating = await repository.update_rating(rating_db, rating)
+    # a delta against the rating read earlier drifts under concurrent
+    # updates, so the profile is rebuilt instead
+    await delete_profile(updated_rating.user_id)
+    await delete_recommendations(updated_rating.user_id)
     return updated_rating
 
 
 async def delete_rating(rating: Rating):
     await repository.delete_rating(rating)
+    await delete_profile(rating.user_id)
+    await delete_recommendations(rating.user_id)
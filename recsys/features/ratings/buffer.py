@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import suppress
+
+from fastapi import HTTPException, status
+
+from recsys.common import metrics
+from recsys.common.database import redis_connection
+from recsys.features.ratings import repository
+from recsys.features.users.repository import (
+    delete_profile,
+    delete_recommendations,
+)
+
+logger = logging.getLogger(__name__)
+
+RATINGS_STREAM = "ratings:buffer"
+RECOVERY_LOCK = "lock:ratings:recovery"
+# stream entries older than this were left behind by a worker that died
+RECOVERY_AGE = float(os.getenv("RATINGS_RECOVERY_AGE", "60"))
+# how long a queued rating blocks another one of the same movie
+PENDING_TIME = int(os.getenv("RATINGS_PENDING_TIME", "3600"))
+
+# the movie is claimed in the same step as the entry is added, so a
+# failed call never leaves a claim behind to reject the next rating
+QUEUE_SCRIPT = """
+if not redis.call("SET", KEYS[2], 1, "NX", "EX", ARGV[4]) then
+    return false
+end
+return redis.call("XADD", KEYS[1], "*", "user_id", ARGV[1],
+                  "movie_id", ARGV[2], "rating", ARGV[3])
+"""
+
+# stream entry id, user id, movie id and rating
+BufferedRating = tuple[str, int, int, int]
+
+
+def pending_key(user_id: int, movie_id: int) -> str:
+    return f"ratings:pending:{user_id}:{movie_id}"
+
+
+class RatingBuffer:
+    def __init__(
+        self,
+        enabled: bool,
+        maxsize: int,
+        batch_size: int,
+        flush_interval: float,
+        put_timeout: float
+    ):
+        self.enabled = enabled
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._pending: list[BufferedRating] = []
+        self._slots: asyncio.Semaphore | None = None
+        self._wake = asyncio.Event()
+        self._flushing = asyncio.Lock()
+
+    def slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.maxsize)
+
+        return self._slots
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def put(self, user_id: int, movie_id: int, rating: int):
+        try:
+            await asyncio.wait_for(self.slots().acquire(), self.put_timeout)
+        except TimeoutError:
+            metrics.increment("recsys_rating_buffer_total",
+                              result="rejected")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many pending ratings, try again later",
+                headers={"Retry-After": "1"}
+            ) from None
+
+        # the stream keeps the rating if this worker dies before flushing it
+        try:
+            async with redis_connection() as conn:
+                queue = conn.register_script(QUEUE_SCRIPT)
+                entry_id = await queue(
+                    keys=[RATINGS_STREAM, pending_key(user_id, movie_id)],
+                    args=[user_id, movie_id, rating, PENDING_TIME]
+                )
+        except Exception:
+            self.slots().release()
+            raise
+
+        # only ratings still buffered are caught here, one repeated after
+        # its batch was written is dropped by the insert-only flush
+        if entry_id is None:
+            self.slots().release()
+            metrics.increment("recsys_rating_buffer_total",
+                              result="duplicate")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Movie already rated"
+            )
+
+        self._pending.append((entry_id, user_id, movie_id, rating))
+        metrics.increment("recsys_rating_buffer_total", result="queued")
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    async def run(self):
+        recovered = float("-inf")
+        while True:
+            # entries of workers that died meanwhile are picked up as well
+            if time.monotonic() - recovered >= RECOVERY_AGE:
+                recovered = time.monotonic()
+                try:
+                    await self.recover()
+                except Exception:
+                    logger.exception("Recovering buffered ratings failed")
+
+            with suppress(TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> bool:
+        async with self._flushing:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                try:
+                    await write_ratings(batch)
+                except Exception:
+                    logger.exception(f"Flushing {len(batch)} ratings failed")
+                    return False
+
+                del self._pending[:len(batch)]
+                for _ in batch:
+                    self.slots().release()
+
+        return True
+
+    async def close(self):
+        if self._pending and not await self.flush():
+            logger.error(f"{len(self._pending)} ratings left in "
+                         f"{RATINGS_STREAM} for recovery")
+
+    async def recover(self, min_age: float = RECOVERY_AGE):
+        async with self._flushing:
+            async with redis_connection() as conn:
+                if not await conn.set(RECOVERY_LOCK, "1", nx=True,
+                                      ex=max(1, round(min_age))):
+                    return
+
+                max_id = int((time.time() - min_age) * 1000)
+                entries = await conn.xrange(RATINGS_STREAM, "-", max_id)
+
+            # this worker still flushes its own entries
+            own_ids = {entry_id for entry_id, *_ in self._pending}
+            batch = [
+                (entry_id, int(fields["user_id"]), int(fields["movie_id"]),
+                 int(fields["rating"]))
+                for entry_id, fields in entries if entry_id not in own_ids
+            ]
+            for start in range(0, len(batch), self.batch_size):
+                await write_ratings(batch[start:start + self.batch_size])
+
+        if batch:
+            logger.info(f"{len(batch)} buffered ratings recovered")
+
+
+async def write_ratings(batch: list[BufferedRating]):
+    # the first rating of a movie wins, like a rating already stored does
+    first: dict[tuple[int, int], int] = {}
+    for _, user_id, movie_id, rating in batch:
+        first.setdefault((user_id, movie_id), rating)
+
+    written = await repository.insert_ratings(
+        (user_id, movie_id, rating)
+        for (user_id, movie_id), rating in first.items()
+    )
+    if written < len(first):
+        logger.warning(f"{len(first) - written} buffered ratings dropped "
+                       "for deleted users or movies or already rated")
+
+    async with redis_connection() as conn:
+        await conn.xdel(RATINGS_STREAM,
+                        *(entry_id for entry_id, *_ in batch))
+        await conn.delete(*(pending_key(user_id, movie_id)
+                            for user_id, movie_id in first))
+
+    # profiles are rebuilt once per user instead of a delta per rating
+    user_ids = {user_id for user_id, _ in first}
+    await asyncio.gather(*(delete_profile(user_id) for user_id in user_ids))
+    await asyncio.gather(*(delete_recommendations(user_id)
+                           for user_id in user_ids))
+
+    metrics.increment("recsys_rating_buffer_total", len(batch),
+                      result="flushed")
+
+
+rating_buffer = RatingBuffer(
+    enabled=os.getenv("RATINGS_WRITE_BEHIND", "false").lower() == "true",
+    maxsize=int(os.getenv("RATINGS_BUFFER_SIZE", "10000")),
+    batch_size=int(os.getenv("RATINGS_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("RATINGS_FLUSH_INTERVAL", "1")),
+    put_timeout=float(os.getenv("RATINGS_BUFFER_TIMEOUT", "1")),
+)
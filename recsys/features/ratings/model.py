@@ -1,21 +1,31 @@
+from typing import Literal
+
+from sqlalchemy import Index
 from sqlmodel import Field, Relationship, SQLModel
 
 from recsys.features.movies.model import Movie
 from recsys.features.users.model import User
 
+MIN_RATING = 0
+MAX_RATING = 5
+BULK_RATINGS_LIMIT = 5000
+
 
 class RatingBase(SQLModel):
     rating: int
 
 
 class Rating(RatingBase, table=True):
+    # the unique key covers the rating so per-user reads skip the table
+    __table_args__ = (
+        Index("ix_rating_user_id_movie_id_rating", "user_id", "movie_id",
+              unique=True, postgresql_include=["rating"]),
+        Index("ix_rating_movie_id", "movie_id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    user_id: int | None = Field(default=None,
-                                foreign_key="user.id",
-                                unique=True)
-    movie_id: int | None = Field(default=None,
-                                 foreign_key="movie.id",
-                                 unique=True)
+    user_id: int | None = Field(default=None, foreign_key="user.id")
+    movie_id: int | None = Field(default=None, foreign_key="movie.id")
 
     user: User | None = Relationship(back_populates="ratings")
     movie: Movie | None = Relationship(back_populates="ratings")
@@ -27,5 +37,24 @@ class RatingPublic(RatingBase):
     movie_id: int
 
 
+class RatingQueued(RatingBase):
+    user_id: int
+    movie_id: int
+
+
 class RatingUpdate(SQLModel):
     rating: int | None = None
+
+
+class RatingItem(RatingBase):
+    movie_id: int
+
+
+class RatingBulk(SQLModel):
+    ratings: list[RatingItem] = Field(max_length=BULK_RATINGS_LIMIT)
+
+
+class RatingItemStatus(SQLModel):
+    movie_id: int
+    status: Literal["created", "updated", "unchanged", "duplicate",
+                    "invalid_rating", "movie_not_found"]
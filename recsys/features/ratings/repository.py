@@ -1,7 +1,14 @@
+from collections.abc import Iterable
+
+from sqlalchemy import Integer, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, Insert, insert
 from sqlmodel import select
 
 from recsys.common.database import postgres_connect
+from recsys.common.pagination import paginate
+from recsys.features.movies.model import Movie
 from recsys.features.ratings.model import Rating, RatingUpdate
+from recsys.features.users.model import User
 
 
 async def get_rating(rating_id: int) -> Rating | None:
@@ -10,14 +17,70 @@ async def get_rating(rating_id: int) -> Rating | None:
         return rating
 
 
-async def get_ratings(skip: int, limit: int):
+async def get_ratings(skip: int, limit: int,
+                      after_id: int | None = None) -> list[Rating]:
     async with postgres_connect() as conn:
-        result = await conn.exec(select(Rating).offset(skip).limit(limit))
+        query = paginate(select(Rating), Rating.id, skip, limit, after_id)
+        result = await conn.exec(query)
         ratings = result.all()
 
         return ratings
 
 
+def upsert_ratings_query(ratings: Iterable[tuple[int, int, int]]) -> Insert:
+    query = insert(Rating).values([
+        {"user_id": user_id, "movie_id": movie_id, "rating": rating}
+        for user_id, movie_id, rating in ratings
+    ])
+    # unchanged ratings are not rewritten
+    return query.on_conflict_do_update(
+        index_elements=[Rating.user_id, Rating.movie_id],
+        set_={"rating": query.excluded.rating},
+        where=Rating.rating != query.excluded.rating
+    )
+
+
+async def insert_ratings(ratings: Iterable[tuple[int, int, int]]) -> int:
+    ratings = list(ratings)
+    async with postgres_connect() as conn:
+        # users or movies deleted since the ratings were accepted would
+        # fail the whole batch on their foreign keys
+        user_ids = bindparam("user_ids", [user_id for user_id, *_ in ratings],
+                             type_=ARRAY(Integer))
+        movie_ids = bindparam("movie_ids",
+                              [movie_id for _, movie_id, _ in ratings],
+                              type_=ARRAY(Integer))
+        users = await conn.exec(
+            select(User.id).where(User.id == any_(user_ids))
+        )
+        movies = await conn.exec(
+            select(Movie.id).where(Movie.id == any_(movie_ids))
+        )
+        existing_users, existing_movies = set(users.all()), set(movies.all())
+
+        ratings = [
+            (user_id, movie_id, rating)
+            for user_id, movie_id, rating in ratings
+            if user_id in existing_users and movie_id in existing_movies
+        ]
+        if not ratings:
+            return 0
+
+        # a rating already stored is kept, so replaying a batch never
+        # overwrites a newer one
+        query = insert(Rating).values([
+            {"user_id": user_id, "movie_id": movie_id, "rating": rating}
+            for user_id, movie_id, rating in ratings
+        ]).on_conflict_do_nothing(
+            index_elements=[Rating.user_id, Rating.movie_id]
+        ).returning(Rating.id)
+        result = await conn.execute(query)
+        inserted = len(result.all())
+        await conn.commit()
+
+        return inserted
+
+
 async def update_rating(rating_db: Rating, new_rating: RatingUpdate) -> Rating:
     async with postgres_connect() as conn:
         rating_data = new_rating.model_dump(exclude_unset=True)
@@ -1,7 +1,8 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Response, status
 
+from recsys.common.pagination import Page, page_params, set_next_cursor
 from recsys.common.security import validate_user_authorization
 from recsys.features.auth.application import get_current_user
 from recsys.features.ratings import application
@@ -17,9 +18,12 @@ router = APIRouter(
 @router.get("/", status_code=status.HTTP_200_OK)
 async def get_ratings(
     current_user: Annotated[User, Depends(get_current_user)],
-    skip: int = 0, limit: int = 100
+    response: Response,
+    page: Annotated[Page, Depends(page_params)],
 ) -> list[RatingPublic]:
-    ratings = await application.get_ratings(skip, limit)
+    ratings = await application.get_ratings(page.skip, page.limit,
+                                            page.after_id)
+    set_next_cursor(response, ratings, page.limit)
     return ratings
 
 
@@ -1,13 +1,35 @@
+import asyncio
 import logging
 import os
+import time
+from uuid import uuid4
 
+import numpy as np
 import pandas as pd
 from fastapi import HTTPException, status
+from scipy.sparse import csr_matrix
 from sqlalchemy.exc import IntegrityError
 
-from recsys.common import security
-from recsys.features.movies.repository import get_all_movies, get_movie
-from recsys.features.users import repository
+from recsys.common import metrics, security
+from recsys.common.cache import SingleFlight
+from recsys.common.ranking import top_k
+from recsys.features.auth.application import invalidate_principal
+from recsys.features.movies.application import get_movies_by_ids
+from recsys.features.movies.catalog import (
+    ACTOR,
+    DIRECTOR,
+    GENRE,
+    Catalog,
+    get_catalog,
+)
+from recsys.features.movies.model import Movie
+from recsys.features.ratings.model import (
+    MAX_RATING,
+    MIN_RATING,
+    RatingItem,
+    RatingItemStatus,
+)
+from recsys.features.users import profile, repository
 from recsys.features.users.model import (
     FavoriteActorBase,
     FavoriteDirectorBase,
@@ -20,9 +42,27 @@ from recsys.features.users.model import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# above this share of the catalog, walking the inverted index costs more
+# than scoring every movie at once
+CANDIDATES_SHARE = 0.25
+
+# users x movies scores held at once while precomputing, 32 MB of float64
+SCORE_BLOCK_CELLS = 2 ** 22
+
+RECOMMENDATIONS_POLL_TIME = 0.05
+
+# offset, limit and the sorted genres a page of recommendations filters by
+RecommendationsPage = tuple[int, int, tuple[str, ...]]
+
+recommendation_flights = SingleFlight()
+
 
-async def get_users(skip: int, limit: int) -> list[UserPublic]:
-    users = await repository.get_users(skip, limit)
+async def get_users(
+    skip: int,
+    limit: int,
+    after_id: int | None = None
+) -> list[UserPublic]:
+    users = await repository.get_users(skip, limit, after_id)
     return users
 
 
@@ -36,7 +76,7 @@ async def get_user(user_id: int) -> User:
 
 
 async def create_user(user: UserCreate) -> UserPublic:
-    user.password = security.get_password_hash(user.password)
+    user.password = await security.hash_password(user.password)
     created_user = await repository.create_user(user)
 
     if isinstance(created_user, IntegrityError):
@@ -56,13 +96,16 @@ async def create_user(user: UserCreate) -> UserPublic:
 async def delete_user(user_id: int):
     user_db = await get_user(user_id)
     await repository.delete_user(user_db)
+    await invalidate_principal(user_db.email)
 
 
 async def update_user(user_id: int, user: UserUpdate) -> UserPublic:
     user_db = await get_user(user_id)
     if user.password:
-        user.password = security.get_password_hash(user.password)
+        user.password = await security.hash_password(user.password)
+    email = user_db.email
     updated_user = await repository.update_user(user_db, user)
+    await invalidate_principal(email)
     return updated_user
 
 
@@ -76,6 +119,8 @@ async def post_favorite_actor(user_id: int, favorite_actor: FavoriteActorBase):
         user_id,
         favorite_actor
     )
+    await profile.apply_favorite(user_id, ACTOR, favorite_actor.name)
+    await repository.delete_recommendations(user_id)
     return created_favorite_actor
 
 
@@ -92,6 +137,8 @@ async def post_favorite_director(
         user_id,
         favorite_director
     )
+    await profile.apply_favorite(user_id, DIRECTOR, favorite_director.name)
+    await repository.delete_recommendations(user_id)
     return created_favorite_director
 
 
@@ -101,20 +148,60 @@ async def get_ratings(user_id: int):
     return ratings
 
 
+async def rate_movies(
+    user_id: int,
+    ratings: list[RatingItem]
+) -> list[RatingItemStatus]:
+    statuses: dict[int, str] = {}
+    latest: dict[int, int] = {}
+    for position, item in enumerate(ratings):
+        if not (MIN_RATING <= item.rating <= MAX_RATING):
+            statuses[position] = "invalid_rating"
+            continue
+
+        # the last rating of a movie wins, as a single upsert may not touch
+        # the same row twice
+        previous = latest.get(item.movie_id)
+        if previous is not None:
+            statuses[previous] = "duplicate"
+        latest[item.movie_id] = position
+
+    existing = await repository.get_existing_movie_ids(list(latest))
+    movie_ratings = {}
+    for movie_id, position in latest.items():
+        if movie_id in existing:
+            movie_ratings[movie_id] = ratings[position].rating
+        else:
+            statuses[position] = "movie_not_found"
+
+    if movie_ratings:
+        inserted = await repository.upsert_ratings(user_id, movie_ratings)
+        for movie_id in movie_ratings:
+            written = inserted.get(movie_id)
+            statuses[latest[movie_id]] = (
+                "unchanged" if written is None
+                else "created" if written else "updated"
+            )
+
+        # one rebuild for the whole batch instead of a delta per rating
+        await repository.delete_profile(user_id)
+        await repository.delete_recommendations(user_id)
+
+    return [
+        RatingItemStatus(movie_id=item.movie_id, status=statuses[position])
+        for position, item in enumerate(ratings)
+    ]
+
+
 def get_favorites_values(favorites) -> list[str]:
     return [favorite.model_dump()["name"] for favorite in favorites]
 
 
 async def get_user_infos(
     user_id: int
-) -> tuple[pd.DataFrame, list[str], list[str]]:
-    ratings = await get_ratings(user_id)
-    ratings_df = pd.DataFrame([rating for rating in ratings])
-    ratings_df = ratings_df.drop(columns=[
-                                     "genres",
-                                     "actors",
-                                     "directors"
-                                 ])
+) -> tuple[np.ndarray, np.ndarray, list[str], list[str]]:
+    movie_ratings = await repository.get_movie_ratings(user_id)
+    movie_ratings = np.array(movie_ratings, dtype=np.int64).reshape(-1, 2)
 
     favorite_actors = get_favorites_values(
         await repository.get_favorite_actors(user_id)
@@ -123,177 +210,354 @@ async def get_user_infos(
         await repository.get_favorite_directors(user_id)
     )
 
-    return ratings_df, favorite_actors, favorite_directors
+    return (movie_ratings[:, 0], movie_ratings[:, 1],
+            favorite_actors, favorite_directors)
 
 
-def generate_favorites_df(
-    base_df: pd.DataFrame,
-    favorites: list[str], name: str
-) -> pd.DataFrame:
-    favorites_rows = []
+async def get_users_infos(
+    user_ids: list[int]
+) -> tuple[list[tuple[int, int, int]], list[tuple[int, int, str]]]:
+    movie_ratings = await repository.get_users_movie_ratings(user_ids)
 
-    for _, row in base_df.iterrows():
-        favorites_flags = {}
-        if row[name]:
-            for value in row[name]:
-                if value in favorites:
-                    favorites_flags[value.strip()] = 1
-                else:
-                    favorites_flags[value.strip()] = 0
-        favorites_rows.append(favorites_flags)
-
-    favorites_df = pd.DataFrame(favorites_rows, index=base_df.index)
-    result_df = pd.concat([base_df, favorites_df], axis=1).fillna(0)
+    favorites = [
+        (user_id, ACTOR, name) for user_id, name in
+        await repository.get_users_favorite_actors(user_ids)
+    ]
+    favorites.extend(
+        (user_id, DIRECTOR, name) for user_id, name in
+        await repository.get_users_favorite_directors(user_ids)
+    )
 
-    return result_df
+    return movie_ratings, favorites
 
 
-def generate_df(base_df: pd.DataFrame, name: str) -> pd.DataFrame:
-    values_rows = []
+def generate_user_profile(
+    catalog: Catalog,
+    rated_rows: np.ndarray,
+    ratings: np.ndarray,
+    feature_mask: np.ndarray
+) -> np.ndarray:
+    user_profile = catalog.matrix[rated_rows].T.dot(
+        ratings.astype(np.float64)
+    )
 
-    for _, row in base_df.iterrows():
-        values_flags = {}
-        if row[name]:
-            for value in row[name]:
-                values_flags[value.strip()] = 1
-        values_rows.append(values_flags)
+    return user_profile * feature_mask
 
-    # Create a DataFrame with the same index and 1s for directors
-    values_df = pd.DataFrame(values_rows, index=base_df.index)
 
-    # Combine original DataFrame with the new one
-    result_df = pd.concat([base_df, values_df], axis=1).fillna(0)
+def log_user_profile(catalog: Catalog, user_profile: np.ndarray):
+    top_features = np.argsort(-user_profile, kind="stable")[:20]
+    top_profile = pd.Series(
+        user_profile[top_features],
+        index=[catalog.features[column] for column in top_features]
+    )
+    logger.info(f"User Profile:\n{top_profile}")
 
-    return result_df
 
+def remove_watcheds_and_sort_recommendations(
+    user_profile: np.ndarray,
+    watched_mask: np.ndarray,
+    catalog: Catalog,
+    k: int
+) -> tuple[list[int], list[float]]:
+    profile_total = user_profile.sum()
+    if not profile_total:
+        return [], []
+
+    profile_columns = np.flatnonzero(user_profile)
+    candidates_limit = len(catalog) * CANDIDATES_SHARE
+    if catalog.postings_size(profile_columns) <= candidates_limit:
+        candidate_rows = catalog.rows_with(profile_columns)
+        candidate_rows = candidate_rows[~watched_mask[candidate_rows]]
+        recommendations = catalog.matrix[candidate_rows].dot(user_profile)
+    else:
+        candidate_rows = np.flatnonzero(~watched_mask)
+        recommendations = catalog.matrix.dot(user_profile)[candidate_rows]
+
+    recommendations /= profile_total
+    top_rows = top_k(recommendations, catalog.movie_ids[candidate_rows], k,
+                     excluded=recommendations <= 0)
+
+    return (catalog.movie_ids[candidate_rows[top_rows]].tolist(),
+            recommendations[top_rows].tolist())
+
+
+def generate_users_profiles(
+    catalog: Catalog,
+    user_ids: list[int],
+    movie_ratings: list[tuple[int, int, int]],
+    favorites: list[tuple[int, int, str]]
+) -> tuple[csr_matrix, csr_matrix]:
+    positions = {
+        user_id: position for position, user_id in enumerate(user_ids)
+    }
+    shape = (len(user_ids), len(catalog))
+
+    movie_ratings = np.array(movie_ratings, dtype=np.int64).reshape(-1, 3)
+    users = np.array([positions[user_id]
+                      for user_id in movie_ratings[:, 0].tolist()],
+                     dtype=np.int64)
+    rows = catalog.rows_of(movie_ratings[:, 1])
+    known = rows >= 0
+    users, rows = users[known], rows[known]
+    ratings = movie_ratings[known, 2]
+
+    rating_matrix = csr_matrix(
+        (ratings.astype(np.float64), (users, rows)), shape=shape
+    )
+    watched_matrix = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (users, rows)), shape=shape
+    )
 
-async def generate_user_profile(
-    genres_df: pd.DataFrame,
-    actors_df: pd.DataFrame,
-    directors_df: pd.DataFrame,
-    user_ratings: pd.DataFrame
-) -> pd.DataFrame:
-    genres_ratings = genres_df[
-        genres_df["title"].isin(user_ratings["title"])
-    ]
-    actors_ratings = actors_df[
-        actors_df["title"].isin(user_ratings["title"])
-    ]
-    directors_ratings = directors_df[
-        directors_df["title"].isin(user_ratings["title"])
+    genre_columns = np.flatnonzero(catalog.feature_kinds == GENRE)
+    mask_users = [np.repeat(np.arange(len(user_ids)), genre_columns.size)]
+    mask_columns = [np.tile(genre_columns, len(user_ids))]
+    for user_id, kind, name in favorites:
+        column = catalog.column(kind, name)
+        if column is not None:
+            mask_users.append([positions[user_id]])
+            mask_columns.append([column])
+
+    mask_users = np.concatenate(mask_users)
+    feature_mask = csr_matrix(
+        (np.ones(mask_users.size), (mask_users, np.concatenate(mask_columns))),
+        shape=(len(user_ids), len(catalog.features))
+    )
+    feature_mask.data[:] = 1
+
+    users_profiles = (rating_matrix @ catalog.matrix).multiply(feature_mask)
+
+    return users_profiles.tocsr(), watched_matrix
+
+
+def recommend_users(
+    catalog: Catalog,
+    users_profiles: csr_matrix,
+    watched_matrix: csr_matrix,
+    k: int,
+    block_cells: int = SCORE_BLOCK_CELLS
+) -> list[tuple[list[int], list[float]]]:
+    profiles_totals = np.asarray(users_profiles.sum(axis=1)).ravel()
+    users = users_profiles.shape[0]
+    block_size = max(1, block_cells // max(users, 1))
+    best = [(np.empty(0, dtype=np.int64), np.empty(0))] * users
+
+    # the catalog is scored in blocks of movies, so memory is bounded by
+    # block_cells whatever the catalog size, and each user keeps a running
+    # top k across blocks
+    for start in range(0, len(catalog), block_size):
+        stop = min(start + block_size, len(catalog))
+        movie_ids = catalog.movie_ids[start:stop]
+        scores = (users_profiles @ catalog.matrix[start:stop].T).toarray()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores /= profiles_totals[:, np.newaxis]
+        watched = watched_matrix[:, start:stop].toarray()
+
+        for position in range(users):
+            top_rows = top_k(scores[position], movie_ids, k,
+                             excluded=watched[position]
+                             | (scores[position] <= 0))
+            best_ids, best_scores = best[position]
+            merged_ids = np.concatenate([best_ids, movie_ids[top_rows]])
+            merged_scores = np.concatenate([best_scores,
+                                            scores[position, top_rows]])
+            keep = top_k(merged_scores, merged_ids, k)
+            best[position] = (merged_ids[keep], merged_scores[keep])
+
+    return [
+        (movie_ids.tolist(), scores.tolist()) for movie_ids, scores in best
     ]
 
-    user_genres = pd.merge(user_ratings, genres_ratings)
-    user_actors = pd.merge(user_ratings, actors_ratings)
-    user_directors = pd.merge(user_ratings, directors_ratings)
-
-    columns_to_drop = [
-        "title", "actors", "directors", "id", "rating", "genres",
-        "id_x", "actors_x", "genres_x", "directors_x", "rating_x",
-        "id_y", "actors_y", "genres_y", "directors_y", "rating_y"
-    ]
 
-    final_df = user_genres.merge(user_actors, on="title")\
-                          .merge(user_directors, on="title")
-    final_df = final_df.drop(columns=columns_to_drop)
+async def generate_recommendation(
+    user_id: int,
+    k: int | None = None
+) -> tuple[list[int], list[float]]:
+    catalog = await get_catalog()
+    user_profile = await profile.get_user_profile(catalog, user_id)
+
+    if user_profile is None:
+        # read before the ratings, so a write landing meanwhile keeps this
+        # profile from being stored
+        version = await repository.get_profile_version(user_id)
+        (
+            rated_movie_ids, ratings, favorite_actors, favorite_directors
+        ) = await get_user_infos(user_id)
+
+        rated_rows = catalog.rows_of(rated_movie_ids)
+        known = rated_rows >= 0
+        rated_rows, ratings = rated_rows[known], ratings[known]
+        feature_mask = catalog.feature_mask(favorite_actors,
+                                            favorite_directors)
+
+        user_profile = generate_user_profile(catalog, rated_rows, ratings,
+                                             feature_mask)
+        await profile.store_user_profile(
+            catalog, user_id, user_profile,
+            profile.favorite_labels(favorite_actors, favorite_directors),
+            version
+        )
+    else:
+        movie_ratings = await repository.get_movie_ratings(user_id)
+        rated_rows = catalog.rows_of(
+            movie_id for movie_id, _ in movie_ratings
+        )
+        rated_rows = rated_rows[rated_rows >= 0]
 
-    user_profile = final_df.T.dot(user_ratings.rating)
+    watched_mask = np.zeros(len(catalog), dtype=bool)
+    watched_mask[rated_rows] = True
 
-    return user_profile
+    log_user_profile(catalog, user_profile)
 
+    return remove_watcheds_and_sort_recommendations(
+        user_profile,
+        watched_mask,
+        catalog,
+        k or int(os.getenv("TOP_N"))
+    )
 
-def just_movies_genres(
-    genres_df: pd.DataFrame,
-    actors_df: pd.DataFrame,
-    directors_df: pd.DataFrame
-) -> pd.DataFrame:
-    movies_and_genres = genres_df.merge(actors_df, on="title")\
-                        .merge(directors_df, on="title")
 
-    columns_to_drop = [
-        "title", "actors", "directors", "genres",
-        "id_x", "actors_x", "directors_x", "genres_x",
-        "id_y", "actors_y", "directors_y", "genres_y"
-    ]
+async def hydrate_recommendations(movie_ids: list[int]) -> list[Movie]:
+    await get_catalog()
+    return await get_movies_by_ids(movie_ids)
 
-    movies_and_genres = movies_and_genres.drop(columns=columns_to_drop)
-    movies_and_genres = movies_and_genres.set_index(movies_and_genres.id)
-    movies_and_genres = movies_and_genres.drop(columns=["id"])
 
-    return movies_and_genres
+def filter_genres(
+    catalog: Catalog,
+    movie_ids: list[int],
+    genres: tuple[str, ...]
+) -> list[int]:
+    columns = [catalog.column(GENRE, genre) for genre in genres]
+    columns = np.array([column for column in columns if column is not None],
+                       dtype=np.int64)
+    rows = catalog.rows_of(movie_ids)
+    matches = np.isin(rows, catalog.rows_with(columns)) & (rows >= 0)
 
+    return np.asarray(movie_ids, dtype=np.int64)[matches].tolist()
 
-def remove_watcheds_and_sort_recommendations(
-    user_profile: pd.DataFrame,
-    user_ratings_df: pd.DataFrame,
-    genres_df: pd.DataFrame,
-    just_movies_and_genres: pd.DataFrame
-) -> list[int]:
-    watcheds = genres_df[genres_df["title"].isin(user_ratings_df["title"])]
 
-    recommendations = (
-        just_movies_and_genres.dot(user_profile)
-    ) / user_profile.sum()
-    recommendations = recommendations[
-        ~recommendations.index.isin(watcheds["id"])
-    ].dropna()
+async def ranked_page(
+    user_id: int,
+    page: RecommendationsPage
+) -> tuple[list[int] | None, bool]:
+    movie_ids, fresh = await repository.get_recommendations(user_id)
+    if movie_ids is None:
+        return None, False
 
-    sorted_recommendations = recommendations.sort_values(ascending=False)
-    top_recommendations = sorted_recommendations.index[
-        :int(os.getenv("TOP_N"))
-    ].tolist()
+    catalog = await get_catalog()
+    return select_page(catalog, movie_ids, page), fresh
 
-    return top_recommendations
 
+def select_page(
+    catalog: Catalog,
+    movie_ids: list[int],
+    page: RecommendationsPage
+) -> list[int]:
+    offset, limit, genres = page
+    if genres:
+        movie_ids = filter_genres(catalog, movie_ids, genres)
 
-async def generate_recommendation(
-    user_id: int
-) -> list[dict[str, str]]:
-    user_ratings_df, favorite_actors, favorite_directors = await get_user_infos(
-        user_id
-    )
+    return movie_ids[offset:offset + limit]
 
-    movies = await get_all_movies()
-    base_df = pd.DataFrame([movie.model_dump() for movie in movies])
 
-    genres_df = generate_df(base_df, "genres")
-    actors_df = generate_favorites_df(
-        base_df, favorite_actors, "actors"
-    )
-    directors_df = generate_favorites_df(
-        base_df, favorite_directors, "directors"
-    )
+async def cached_recommendation(
+    user_id: int,
+    page: RecommendationsPage
+) -> tuple[list[Movie] | None, bool]:
+    pages = repository.local_recommendations.get(user_id) or {}
+    recommendations = pages.get(page)
+    if recommendations is not None:
+        metrics.increment("recsys_cache_requests_total", tier="local",
+                          result="hit")
+        return recommendations, True
+
+    metrics.increment("recsys_cache_requests_total", tier="local",
+                      result="miss")
+
+    movie_ids, fresh = await ranked_page(user_id, page)
+    if movie_ids is None:
+        return None, False
+
+    recommendations = await hydrate_recommendations(movie_ids)
+    if fresh and recommendations:
+        pages = {**pages, page: recommendations}
+        while len(pages) > repository.LOCAL_CACHE_PAGES:
+            del pages[next(iter(pages))]
+        repository.local_recommendations.set(user_id, pages)
+
+    return recommendations, fresh
+
+
+async def refresh_recommendation(user_id: int) -> list[int] | None:
+    token = uuid4().hex
+    if not await repository.lock_recommendations(user_id, token):
+        return None
+
+    try:
+        # read before computing, so a write landing meanwhile keeps this
+        # ranking from being stored
+        versions = await repository.get_recommendations_versions([user_id])
+        movie_ids, scores = await generate_recommendation(
+            user_id, int(os.getenv("RECOMMENDATIONS_DEPTH", "200"))
+        )
+        await repository.store_recommendations(user_id, movie_ids, scores,
+                                               versions[user_id])
+    finally:
+        await repository.unlock_recommendations(user_id, token)
 
-    user_profile = await generate_user_profile(genres_df, actors_df,
-                                               directors_df, user_ratings_df)
-    logger.info(
-        f"User Profile:\n{user_profile.sort_values(ascending=False).head(20)}"
-    )
+    return movie_ids
 
-    just_movies_and_genres = just_movies_genres(genres_df, actors_df,
-                                                directors_df)
 
-    top_recommendations = remove_watcheds_and_sort_recommendations(
-        user_profile,
-        user_ratings_df,
-        genres_df,
-        just_movies_and_genres
+async def wait_recommendation(user_id: int) -> list[int]:
+    # another worker holds the lock, so its result is awaited before
+    # falling back to computing it here
+    deadline = time.monotonic() + int(
+        os.getenv("RECOMMENDATIONS_LOCK_TIME", "30")
     )
+    while time.monotonic() < deadline:
+        await asyncio.sleep(RECOMMENDATIONS_POLL_TIME)
+        movie_ids, _ = await repository.get_recommendations(user_id)
+        if movie_ids is not None:
+            return movie_ids
+
+    movie_ids, _ = await generate_recommendation(
+        user_id, int(os.getenv("RECOMMENDATIONS_DEPTH", "200"))
+    )
+    return movie_ids
 
-    recommended_movies = []
-    for i in top_recommendations:
-        movie = await get_movie(i)
-        recommended_movies.append(movie)
-
-    return recommended_movies
 
+async def load_recommendation(user_id: int) -> list[int]:
+    movie_ids = await refresh_recommendation(user_id)
+    if movie_ids is None:
+        movie_ids = await wait_recommendation(user_id)
 
-async def user_recommendation(user_id: int):
-    recommendations = repository.get_recommendations(user_id)
+    return movie_ids
 
-    if not recommendations:
-        recommendations = await generate_recommendation(user_id)
 
-        repository.store_recommendations(user_id, recommendations)
+async def user_recommendation(
+    user_id: int,
+    offset: int = 0,
+    limit: int | None = None,
+    genres: list[str] | None = None
+) -> list[Movie]:
+    page = (offset, limit or int(os.getenv("TOP_N")),
+            tuple(sorted(set(genres or []))))
+    recommendations, fresh = await cached_recommendation(user_id, page)
+
+    if recommendations is None:
+        movie_ids = await recommendation_flights.wait(
+            user_id, lambda: load_recommendation(user_id)
+        )
+        # the shared flight may have been a background refresh that lost
+        # the lock to another worker
+        if movie_ids is None:
+            movie_ids = await wait_recommendation(user_id)
+
+        catalog = await get_catalog()
+        recommendations = await hydrate_recommendations(
+            select_page(catalog, movie_ids, page)
+        )
+    elif not fresh:
+        recommendation_flights.run(user_id,
+                                   lambda: refresh_recommendation(user_id))
 
     return recommendations
@@ -0,0 +1,124 @@
+import numpy as np
+
+from recsys.features.movies.catalog import (
+    ACTOR,
+    DIRECTOR,
+    Catalog,
+    feature_label,
+    get_catalog,
+    parse_feature_label,
+)
+from recsys.features.users import repository
+
+FAVORITE_PREFIX = "favorite:"
+# catalog generation the stored profile was computed against
+GENERATION_FIELD = "generation"
+
+
+def profile_values(
+    catalog: Catalog,
+    user_profile: np.ndarray
+) -> dict[str, float]:
+    return {
+        catalog.label(column): float(user_profile[column])
+        for column in np.flatnonzero(user_profile).tolist()
+    }
+
+
+def parse_profile(
+    catalog: Catalog,
+    stored_profile: dict[str, str]
+) -> tuple[np.ndarray, set[str]]:
+    user_profile = np.zeros(len(catalog.features))
+    favorites = set()
+
+    for field, value in stored_profile.items():
+        if field == GENERATION_FIELD:
+            continue
+
+        if field.startswith(FAVORITE_PREFIX):
+            favorites.add(field.removeprefix(FAVORITE_PREFIX))
+            continue
+
+        key = parse_feature_label(field)
+        column = catalog.column(*key) if key else None
+        if column is not None:
+            user_profile[column] = float(value)
+
+    return user_profile, favorites
+
+
+def favorite_labels(
+    favorite_actors: list[str],
+    favorite_directors: list[str]
+) -> list[str]:
+    return [
+        *(feature_label(ACTOR, name) for name in favorite_actors),
+        *(feature_label(DIRECTOR, name) for name in favorite_directors),
+    ]
+
+
+async def get_user_profile(
+    catalog: Catalog,
+    user_id: int
+) -> np.ndarray | None:
+    stored_profile = await repository.get_profile(user_id)
+    # movies edited since then changed the features it was summed from
+    if (stored_profile is None or stored_profile.get(GENERATION_FIELD)
+            != str(catalog.generation)):
+        return None
+
+    user_profile, _ = parse_profile(catalog, stored_profile)
+    return user_profile
+
+
+async def store_user_profile(
+    catalog: Catalog,
+    user_id: int,
+    user_profile: np.ndarray,
+    favorites: list[str],
+    version: str
+) -> bool:
+    return await repository.store_profile(
+        user_id, profile_values(catalog, user_profile), favorites, version,
+        str(catalog.generation)
+    )
+
+
+async def apply_rating(user_id: int, movie_id: int, delta: float,
+                       version: str):
+    # the version is bumped before the rating is written, so a recompute
+    # that may have read it leaves a mismatch and drops the profile
+    catalog = await get_catalog()
+    if catalog.row(movie_id) is None:
+        await repository.delete_profile(user_id)
+        return
+
+    labels = [
+        catalog.label(column)
+        for column in catalog.columns_of(movie_id).tolist()
+    ]
+    await repository.increment_profile(user_id, labels, delta, version,
+                                       str(catalog.generation))
+
+
+async def apply_favorite(user_id: int, kind: int, name: str):
+    catalog = await get_catalog()
+    # read before the ratings, so a rating written meanwhile drops the
+    # profile instead of being left out of the favorite's delta
+    version = await repository.get_profile_version(user_id)
+
+    delta = 0.0
+    column = catalog.column(kind, name)
+    if column is not None:
+        movie_ratings = await repository.get_movie_ratings(user_id)
+        movie_ratings = np.array(movie_ratings, dtype=np.int64).reshape(-1, 2)
+        rated_rows = catalog.rows_of(movie_ratings[:, 0])
+        known = rated_rows >= 0
+
+        featured = catalog.matrix[rated_rows[known]][:, column].toarray()
+        delta = float(featured.ravel() @ movie_ratings[known, 1])
+
+    await repository.add_profile_favorite(user_id, feature_label(kind, name),
+                                          delta, version,
+                                          str(catalog.generation))
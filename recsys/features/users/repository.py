@@ -1,12 +1,21 @@
 import json
 import os
+import zlib
 
+import numpy as np
+from redis.asyncio.client import Pipeline
+from sqlalchemy import Integer, any_, bindparam, literal_column
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import IntegrityError
 from sqlmodel import select
 
+from recsys.common import metrics
+from recsys.common.cache import LRUCache, jittered_ttl
 from recsys.common.database import postgres_connect, redis_connection
+from recsys.common.pagination import paginate
 from recsys.features.movies.model import Movie
 from recsys.features.ratings.model import Rating
+from recsys.features.ratings.repository import upsert_ratings_query
 from recsys.features.users.model import (
     FavoriteActor,
     FavoriteActorBase,
@@ -17,6 +26,103 @@ from recsys.features.users.model import (
     UserUpdate,
 )
 
+INVALIDATIONS_CHANNEL = "recommendations:invalidate"
+
+RECOMMENDATIONS_FORMAT = b"\x01"
+COMPRESSED_RECOMMENDATIONS_FORMAT = b"\x02"
+
+# ready-to-serve recommendations kept in each worker in front of Redis
+local_recommendations = LRUCache(
+    maxsize=int(os.getenv("LOCAL_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("LOCAL_CACHE_TIME", "60")),
+)
+# offsets and genres are chosen by the client, so the pages kept per user
+# are capped as well
+LOCAL_CACHE_PAGES = int(os.getenv("LOCAL_CACHE_PAGES", "4"))
+
+UNLOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# writes bump the user's recommendations version, so a computation that
+# started before them does not store its outdated ranking
+RECOMMENDATIONS_STORE_SCRIPT = """
+if (redis.call("GET", KEYS[3]) or "0") ~= ARGV[1] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+redis.call("SET", KEYS[2], 1, "EX", ARGV[4])
+return 1
+"""
+
+# every profile write bumps the user's profile version, even while no
+# profile is stored, so a full recompute that read older ratings or
+# favorites does not store its result; storing bumps it as well, so a
+# delta whose rating a recompute may already have read drops the profile
+PROFILE_STORE_SCRIPT = """
+if (redis.call("GET", KEYS[2]) or "0") ~= ARGV[1] then
+    return 0
+end
+redis.call("DEL", KEYS[1])
+for i = 3, #ARGV, 2 do
+    redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+redis.call("INCR", KEYS[2])
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+return 1
+"""
+
+PROFILE_INCREMENT_SCRIPT = """
+local version = redis.call("GET", KEYS[2]) or "0"
+redis.call("INCR", KEYS[2])
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+if version ~= ARGV[3]
+    or redis.call("HGET", KEYS[1], "generation") ~= ARGV[4] then
+    redis.call("DEL", KEYS[1])
+    return 0
+end
+for i = 5, #ARGV do
+    local label = ARGV[i]
+    if string.sub(label, 1, 6) == "genre:"
+        or redis.call("HEXISTS", KEYS[1], "favorite:" .. label) == 1 then
+        redis.call("HINCRBYFLOAT", KEYS[1], label, ARGV[1])
+    end
+end
+return 1
+"""
+
+PROFILE_FAVORITE_SCRIPT = """
+local version = redis.call("GET", KEYS[2]) or "0"
+redis.call("INCR", KEYS[2])
+redis.call("EXPIRE", KEYS[2], ARGV[4])
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+if version ~= ARGV[3]
+    or redis.call("HGET", KEYS[1], "generation") ~= ARGV[5] then
+    redis.call("DEL", KEYS[1])
+    return 0
+end
+if redis.call("HSETNX", KEYS[1], "favorite:" .. ARGV[1], 1) == 1 then
+    redis.call("HINCRBYFLOAT", KEYS[1], ARGV[1], ARGV[2])
+end
+return 1
+"""
+
+PROFILE_DELETE_SCRIPT = """
+redis.call("DEL", KEYS[1])
+redis.call("INCR", KEYS[2])
+redis.call("EXPIRE", KEYS[2], ARGV[1])
+return 1
+"""
+
 
 async def create_user(user: UserBase):
     async with postgres_connect() as conn:
@@ -31,14 +137,26 @@ async def create_user(user: UserBase):
             return error
 
 
-async def get_users(skip: int, limit: int) -> list[User]:
+async def get_users(skip: int, limit: int,
+                    after_id: int | None = None) -> list[User]:
     async with postgres_connect() as conn:
-        result = await conn.exec(select(User).offset(skip).limit(limit))
+        query = paginate(select(User), User.id, skip, limit, after_id)
+        result = await conn.exec(query)
         users = result.all()
 
         return users
 
 
+async def get_user_ids(after_id: int, limit: int) -> list[int]:
+    async with postgres_connect() as conn:
+        query = select(User.id).where(User.id > after_id)\
+                .order_by(User.id).limit(limit)
+        result = await conn.exec(query)
+        user_ids = result.all()
+
+        return user_ids
+
+
 async def get_user(user_id: int) -> User | None:
     async with postgres_connect() as conn:
         user = await conn.get(User, user_id)
@@ -146,20 +264,327 @@ async def get_ratings(user_id: int):
         return ratings
 
 
-def store_recommendations(user_id: int, recommendations: dict[str, str]):
-    recommendations_in_json = [r.dict() for r in recommendations]
-    with redis_connection() as conn:
-        conn.setex(f"{user_id}", int(os.getenv("CACHE_TIME")),
-                   json.dumps(recommendations_in_json))
+async def get_existing_movie_ids(movie_ids: list[int]) -> set[int]:
+    async with postgres_connect() as conn:
+        ids = bindparam("movie_ids", movie_ids, type_=ARRAY(Integer))
+        result = await conn.exec(select(Movie.id).where(Movie.id == any_(ids)))
+
+        return set(result.all())
+
+
+async def upsert_ratings(
+    user_id: int,
+    movie_ratings: dict[int, int]
+) -> dict[int, bool]:
+    async with postgres_connect() as conn:
+        # unchanged ratings are not returned, and xmax is only zero for
+        # freshly inserted rows
+        query = upsert_ratings_query(
+            (user_id, movie_id, rating)
+            for movie_id, rating in movie_ratings.items()
+        ).returning(Rating.movie_id, literal_column("xmax = 0"))
+        result = await conn.execute(query)
+        inserted = dict(result.all())
+        await conn.commit()
+
+        return inserted
+
+
+async def get_movie_ratings(user_id: int) -> list[tuple[int, int]]:
+    async with postgres_connect() as conn:
+        query = select(Rating.movie_id, Rating.rating)\
+                .where(Rating.user_id == user_id)
+        result = await conn.exec(query)
+        movie_ratings = result.all()
+
+        return movie_ratings
+
+
+async def get_users_movie_ratings(
+    user_ids: list[int]
+) -> list[tuple[int, int, int]]:
+    async with postgres_connect() as conn:
+        query = select(Rating.user_id, Rating.movie_id, Rating.rating)\
+                .where(Rating.user_id.in_(user_ids))
+        result = await conn.exec(query)
+        movie_ratings = [tuple(r) for r in result.all()]
+
+        return movie_ratings
+
+
+async def get_users_favorite_actors(
+    user_ids: list[int]
+) -> list[tuple[int, str]]:
+    async with postgres_connect() as conn:
+        query = select(FavoriteActor.user_id, FavoriteActor.name)\
+                .where(FavoriteActor.user_id.in_(user_ids))
+        result = await conn.exec(query)
+        favorite_actors = [tuple(r) for r in result.all()]
+
+        return favorite_actors
+
+
+async def get_users_favorite_directors(
+    user_ids: list[int]
+) -> list[tuple[int, str]]:
+    async with postgres_connect() as conn:
+        query = select(FavoriteDirector.user_id, FavoriteDirector.name)\
+                .where(FavoriteDirector.user_id.in_(user_ids))
+        result = await conn.exec(query)
+        favorite_directors = [tuple(r) for r in result.all()]
+
+        return favorite_directors
+
+
+def recommendations_key(user_id: int) -> str:
+    return f"{user_id}"
+
+
+def fresh_recommendations_key(user_id: int) -> str:
+    return f"fresh:{user_id}"
+
+
+def recommendations_lock_key(user_id: int) -> str:
+    return f"lock:{user_id}"
+
+
+def recommendations_version_key(user_id: int) -> str:
+    return f"version:{user_id}"
+
 
+def recommendations_time() -> tuple[int, int]:
+    # fresh and stale seconds of a stored ranking
+    fresh_time = jittered_ttl(int(os.getenv("CACHE_TIME")),
+                              float(os.getenv("CACHE_JITTER", "0.1")))
+    stale_time = int(os.getenv("CACHE_STALE_TIME", os.getenv("CACHE_TIME")))
 
-def get_recommendations(user_id: int) -> dict[str, str] | None:
-    with redis_connection() as conn:
-        result = conn.get(f"{user_id}")
+    return fresh_time, stale_time
 
-        if result:
-            recommendations_in_json = json.loads(result)
-            recommendations = [Movie(**r) for r in recommendations_in_json]
-            return recommendations
 
-        return None
+def pack_recommendations(movie_ids: list[int], scores: list[float]) -> bytes:
+    payload = (np.asarray(movie_ids, dtype="<i4").tobytes()
+               + np.asarray(scores, dtype="<f4").tobytes())
+
+    if os.getenv("CACHE_COMPRESSION", "zlib") == "zlib":
+        return COMPRESSED_RECOMMENDATIONS_FORMAT + zlib.compress(payload)
+
+    return RECOMMENDATIONS_FORMAT + payload
+
+
+def unpack_recommendations(packed: bytes) -> tuple[list[int], list[float]]:
+    packed_format, payload = packed[:1], packed[1:]
+    if packed_format == COMPRESSED_RECOMMENDATIONS_FORMAT:
+        payload = zlib.decompress(payload)
+    elif packed_format != RECOMMENDATIONS_FORMAT:
+        # entries written before the packed format are lists of movies
+        recommendations_in_json = json.loads(packed)
+        return [r["id"] for r in recommendations_in_json], []
+
+    size = len(payload) // 8
+    return (np.frombuffer(payload, dtype="<i4", count=size).tolist(),
+            np.frombuffer(payload, dtype="<f4", offset=size * 4).tolist())
+
+
+async def queue_recommendations(
+    pipeline: Pipeline,
+    user_id: int,
+    movie_ids: list[int],
+    scores: list[float],
+    version: str
+):
+    # the ranking keeps the computed order, ties included, so every page
+    # is sliced from the same sequence; it outlives its fresh marker so it
+    # can be served stale while a single refresh runs
+    fresh_time, stale_time = recommendations_time()
+    store = pipeline.register_script(RECOMMENDATIONS_STORE_SCRIPT)
+
+    await store(
+        keys=[recommendations_key(user_id), fresh_recommendations_key(user_id),
+              recommendations_version_key(user_id)],
+        args=[version, pack_recommendations(movie_ids, scores),
+              fresh_time + stale_time, fresh_time],
+        client=pipeline
+    )
+
+
+async def get_recommendations_versions(
+    user_ids: list[int]
+) -> dict[int, str]:
+    async with redis_connection() as conn:
+        versions = await conn.mget(
+            [recommendations_version_key(user_id) for user_id in user_ids]
+        )
+
+    return {
+        user_id: version or "0"
+        for user_id, version in zip(user_ids, versions)
+    }
+
+
+async def store_recommendations(
+    user_id: int,
+    movie_ids: list[int],
+    scores: list[float],
+    version: str
+) -> bool:
+    async with redis_connection(binary=True) as conn:
+        pipeline = conn.pipeline(transaction=False)
+        await queue_recommendations(pipeline, user_id, movie_ids, scores,
+                                    version)
+        stored, = await pipeline.execute()
+
+        return bool(stored)
+
+
+async def store_many_recommendations(
+    users_recommendations: dict[int, tuple[list[int], list[float]]],
+    versions: dict[int, str]
+) -> int:
+    async with redis_connection(binary=True) as conn:
+        pipeline = conn.pipeline(transaction=False)
+        for user_id, (movie_ids, scores) in users_recommendations.items():
+            await queue_recommendations(pipeline, user_id, movie_ids, scores,
+                                        versions[user_id])
+        stored = await pipeline.execute()
+
+        return sum(stored)
+
+
+async def get_recommendations(user_id: int) -> tuple[list[int] | None, bool]:
+    async with redis_connection(binary=True) as conn:
+        packed, fresh = await conn.mget(recommendations_key(user_id),
+                                        fresh_recommendations_key(user_id))
+
+    if packed is None:
+        metrics.increment("recsys_cache_requests_total", tier="redis",
+                          result="miss")
+        return None, False
+
+    metrics.increment("recsys_cache_requests_total", tier="redis",
+                      result="hit" if fresh is not None else "stale")
+
+    movie_ids, _ = unpack_recommendations(packed)
+    return movie_ids, fresh is not None
+
+
+async def delete_recommendations(user_id: int):
+    local_recommendations.delete(user_id)
+
+    fresh_time, stale_time = recommendations_time()
+    async with redis_connection() as conn:
+        pipeline = conn.pipeline()
+        pipeline.incr(recommendations_version_key(user_id))
+        pipeline.expire(recommendations_version_key(user_id),
+                        fresh_time + stale_time)
+        pipeline.delete(recommendations_key(user_id),
+                        fresh_recommendations_key(user_id))
+        pipeline.publish(INVALIDATIONS_CHANNEL, user_id)
+        await pipeline.execute()
+
+
+async def lock_recommendations(user_id: int, token: str) -> bool:
+    async with redis_connection() as conn:
+        return bool(await conn.set(
+            recommendations_lock_key(user_id), token, nx=True,
+            ex=int(os.getenv("RECOMMENDATIONS_LOCK_TIME", "30"))
+        ))
+
+
+async def unlock_recommendations(user_id: int, token: str):
+    async with redis_connection() as conn:
+        unlock = conn.register_script(UNLOCK_SCRIPT)
+        await unlock(keys=[recommendations_lock_key(user_id)], args=[token])
+
+
+def profile_key(user_id: int) -> str:
+    return f"profile:{user_id}"
+
+
+def profile_version_key(user_id: int) -> str:
+    return f"profile:version:{user_id}"
+
+
+def profile_time() -> int:
+    return int(os.getenv("PROFILE_TIME", "86400"))
+
+
+async def get_profile(user_id: int) -> dict[str, str] | None:
+    async with redis_connection() as conn:
+        profile = await conn.hgetall(profile_key(user_id))
+
+        return profile or None
+
+
+async def get_profile_version(user_id: int) -> str:
+    async with redis_connection() as conn:
+        version = await conn.get(profile_version_key(user_id))
+
+        return version or "0"
+
+
+async def bump_profile_version(user_id: int) -> str:
+    async with redis_connection() as conn:
+        pipeline = conn.pipeline()
+        pipeline.incr(profile_version_key(user_id))
+        pipeline.expire(profile_version_key(user_id), profile_time())
+        version, _ = await pipeline.execute()
+
+        return str(version)
+
+
+async def store_profile(
+    user_id: int,
+    profile: dict[str, float],
+    favorites: list[str],
+    version: str,
+    generation: str
+) -> bool:
+    mapping = {
+        "generation": generation,
+        **profile,
+        **{f"favorite:{label}": 1 for label in favorites}
+    }
+    async with redis_connection() as conn:
+        store = conn.register_script(PROFILE_STORE_SCRIPT)
+        return bool(await store(
+            keys=[profile_key(user_id), profile_version_key(user_id)],
+            args=[version, profile_time(),
+                  *(item for field in mapping.items() for item in field)]
+        ))
+
+
+async def increment_profile(
+    user_id: int,
+    labels: list[str],
+    delta: float,
+    version: str,
+    generation: str
+) -> bool:
+    async with redis_connection() as conn:
+        increment = conn.register_script(PROFILE_INCREMENT_SCRIPT)
+        return bool(await increment(
+            keys=[profile_key(user_id), profile_version_key(user_id)],
+            args=[delta, profile_time(), version, generation, *labels]
+        ))
+
+
+async def add_profile_favorite(
+    user_id: int,
+    label: str,
+    delta: float,
+    version: str,
+    generation: str
+) -> bool:
+    async with redis_connection() as conn:
+        add_favorite = conn.register_script(PROFILE_FAVORITE_SCRIPT)
+        return bool(await add_favorite(
+            keys=[profile_key(user_id), profile_version_key(user_id)],
+            args=[label, delta, version, profile_time(), generation]
+        ))
+
+
+async def delete_profile(user_id: int):
+    async with redis_connection() as conn:
+        delete = conn.register_script(PROFILE_DELETE_SCRIPT)
+        await delete(keys=[profile_key(user_id), profile_version_key(user_id)],
+                     args=[profile_time()])
@@ -1,9 +1,11 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, Response, status
 
+from recsys.common.pagination import Page, page_params, set_next_cursor
 from recsys.common.security import validate_user_authorization
 from recsys.features.auth.application import get_current_user
+from recsys.features.ratings.model import RatingBulk, RatingItemStatus
 from recsys.features.users import application
 from recsys.features.users.model import (
     FavoriteActorBase,
@@ -23,9 +25,12 @@ router = APIRouter(
 @router.get("/", status_code=status.HTTP_200_OK)
 async def get_users(
     current_user: Annotated[User, Depends(get_current_user)],
-    skip: int = 0, limit: int = 100,
+    response: Response,
+    page: Annotated[Page, Depends(page_params)],
 ) -> list[UserPublic]:
-    users = await application.get_users(skip, limit)
+    users = await application.get_users(page.skip, page.limit,
+                                        page.after_id)
+    set_next_cursor(response, users, page.limit)
     return users
 
 
@@ -45,11 +50,26 @@ async def get_user_ratings(
     return ratings
 
 
+@router.post("/ratings/bulk", status_code=status.HTTP_200_OK)
+async def post_user_ratings(
+    ratings: RatingBulk,
+    current_user: Annotated[User, Depends(get_current_user)]
+) -> list[RatingItemStatus]:
+    statuses = await application.rate_movies(current_user.id,
+                                             ratings.ratings)
+    return statuses
+
+
 @router.get("/recommendations", status_code=status.HTTP_200_OK)
 async def get_user_recommendations(
-    current_user: Annotated[User, Depends(get_current_user)]
+    current_user: Annotated[User, Depends(get_current_user)],
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int | None, Query(ge=1, le=100)] = None,
+    genre: Annotated[list[str] | None, Query()] = None,
 ):
-    recommendations = await application.user_recommendation(current_user.id)
+    recommendations = await application.user_recommendation(
+        current_user.id, offset, limit, genre
+    )
     return recommendations
 
 
@@ -1,13 +1,65 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
+from recsys.common import metrics, security
+from recsys.common.cache import listen_invalidations
+from recsys.common.database import (
+    binary_redis_client,
+    close_postgres,
+    close_redis,
+    postgres_client,
+    redis_client,
+)
+from recsys.features.auth import application as auth_application
 from recsys.features.auth import routes as auth_router
 from recsys.features.movies import routes as movie_router
+from recsys.features.movies.catalog import catalog_loader
+from recsys.features.movies.repository import CATALOG_CHANNEL
 from recsys.features.ratings import routes as rating_router
+from recsys.features.ratings.buffer import rating_buffer
+from recsys.features.users import repository as user_repository
 from recsys.features.users import routes as user_router
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    postgres_client.open()
+    redis_client.open()
+    binary_redis_client.open()
+    invalidations = asyncio.create_task(listen_invalidations({
+        user_repository.INVALIDATIONS_CHANNEL: (
+            user_repository.local_recommendations, int
+        ),
+        auth_application.PRINCIPALS_CHANNEL: (
+            auth_application.principals, str
+        ),
+        CATALOG_CHANNEL: (catalog_loader, int),
+    }))
+    tasks = [invalidations]
+    if rating_buffer.enabled:
+        tasks.append(asyncio.create_task(rating_buffer.run()))
+    yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await rating_buffer.close()
+    await close_redis()
+    await close_postgres()
+    security.password_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(auth_router.router)
 app.include_router(user_router.router)
 app.include_router(movie_router.router)
 app.include_router(rating_router.router)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    return metrics.render()
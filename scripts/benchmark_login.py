@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import logging
+import time
+
+import httpx
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def probe(client: httpx.AsyncClient, path: str, stop: asyncio.Event,
+                interval: float) -> list[float]:
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await client.get(path)
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+
+    return latencies
+
+
+async def login_storm(client: httpx.AsyncClient, email: str, password: str,
+                      logins: int, concurrency: int) -> dict[int, int]:
+    statuses: dict[int, int] = {}
+    remaining = iter(range(logins))
+
+    async def worker():
+        for _ in remaining:
+            response = await client.post(
+                "/auth/token", json={"email": email, "password": password}
+            )
+            statuses[response.status_code] = (
+                statuses.get(response.status_code, 0) + 1
+            )
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return statuses
+
+
+async def measure_probe(client: httpx.AsyncClient, path: str,
+                        interval: float, work=None):
+    stop = asyncio.Event()
+    probing = asyncio.create_task(probe(client, path, stop, interval))
+
+    started = time.perf_counter()
+    result = await work if work is not None else await asyncio.sleep(2)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    return await probing, result, elapsed
+
+
+def log_latencies(phase: str, latencies: list[float]):
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    logger.info(f"{phase}: {len(latencies)} probes, p50 {p50:.1f}ms, "
+                f"p99 {p99:.1f}ms")
+
+
+async def benchmark_login(args: argparse.Namespace):
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits,
+                                 timeout=60) as client:
+        baseline, _, _ = await measure_probe(client, args.probe_path,
+                                             args.interval)
+        log_latencies("Idle", baseline)
+
+        during, statuses, elapsed = await measure_probe(
+            client, args.probe_path, args.interval,
+            login_storm(client, args.email, args.password, args.logins,
+                        args.concurrency)
+        )
+        log_latencies("Login storm", during)
+
+    accepted = statuses.get(200, 0)
+    logger.info(f"{args.logins} logins in {elapsed:.2f}s, "
+                f"{accepted / elapsed:.1f} accepted/s, "
+                f"statuses {dict(sorted(statuses.items()))}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure login throughput and the latency of another "
+                    "endpoint while logins are hashing passwords"
+    )
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--probe-path", default="/metrics",
+                        help="endpoint whose latency is sampled")
+    parser.add_argument("--interval", type=float, default=0.01,
+                        help="seconds between probe requests")
+    args = parser.parse_args()
+
+    asyncio.run(benchmark_login(args))
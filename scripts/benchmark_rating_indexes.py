@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import logging
+import re
+
+from recsys.common.database import close_postgres, postgres_client
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BENCH_DOMAIN = "bench.local"
+
+# name, the column the query filters on and the query itself
+QUERIES = (
+    # users/repository.get_ratings
+    ("user ratings", "user_id", """
+        SELECT movie.id, movie.title, movie.genres, movie.actors,
+               movie.directors, rating.rating
+        FROM rating JOIN movie ON movie.id = rating.movie_id
+        WHERE rating.user_id = $1
+    """),
+    # users/repository.get_movie_ratings
+    ("user movie ratings", "user_id", """
+        SELECT rating.movie_id, rating.rating
+        FROM rating WHERE rating.user_id = $1
+    """),
+    # movies/repository.get_movie_ratings
+    ("movie ratings", "movie_id", """
+        SELECT rating.rating, rating.id, rating.user_id, rating.movie_id
+        FROM rating WHERE rating.movie_id = $1
+    """),
+)
+
+# planner switches that make postgres read rating as if it had no indexes
+WITHOUT_INDEXES = (
+    "SET LOCAL enable_indexscan = off",
+    "SET LOCAL enable_indexonlyscan = off",
+    "SET LOCAL enable_bitmapscan = off",
+)
+
+EXECUTION_TIME = re.compile(r"Execution Time: ([\d.]+) ms")
+
+
+async def seed(driver, users: int, movies: int, ratings_per_user: int):
+    await driver.execute(f"""
+        INSERT INTO "user" (name, email, password)
+        SELECT 'bench ' || g, 'bench' || g || '@{BENCH_DOMAIN}', '-'
+        FROM generate_series(1, {users}) AS g
+        ON CONFLICT (email) DO NOTHING
+    """)
+    first_movie, last_movie = await driver.fetchrow(f"""
+        WITH created AS (
+            INSERT INTO movie (title, genres)
+            SELECT 'Bench movie ' || g, ARRAY['Drama']
+            FROM generate_series(1, {movies}) AS g
+            RETURNING id
+        )
+        SELECT min(id), max(id) FROM created
+    """)
+    await driver.execute(f"""
+        INSERT INTO rating (user_id, movie_id, rating)
+        SELECT "user".id,
+               {first_movie} + abs(hashtext("user".id || ':' || g)::bigint)
+                   % {last_movie - first_movie + 1},
+               abs(hashtext(g || ':' || "user".id)::bigint) % 6
+        FROM "user", generate_series(1, {ratings_per_user}) AS g
+        WHERE "user".email LIKE '%@{BENCH_DOMAIN}'
+        ON CONFLICT (user_id, movie_id) DO NOTHING
+    """)
+    logger.info(f"Seeded {users} users, {movies} movies and up to "
+                f"{users * ratings_per_user} ratings")
+
+
+async def explain(driver, query: str, value: int,
+                  with_indexes: bool) -> str:
+    async with driver.transaction():
+        if not with_indexes:
+            for setting in WITHOUT_INDEXES:
+                await driver.execute(setting)
+
+        rows = await driver.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {query}",
+                                  value)
+
+    return "\n".join(row[0] for row in rows)
+
+
+async def benchmark_rating_indexes(args: argparse.Namespace):
+    async with postgres_client.open().connect() as conn:
+        raw_connection = await conn.get_raw_connection()
+        driver = raw_connection.driver_connection
+
+        if args.seed:
+            await seed(driver, args.users, args.movies,
+                       args.ratings_per_user)
+        # index-only scans need a fresh visibility map
+        await driver.execute("VACUUM ANALYZE rating")
+
+        sample = await driver.fetchrow(
+            "SELECT user_id, movie_id FROM rating ORDER BY id DESC LIMIT 1"
+        )
+        for name, column, query in QUERIES:
+            for with_indexes in (False, True):
+                plan = await explain(driver, query, sample[column],
+                                     with_indexes)
+                label = "with indexes" if with_indexes else "without indexes"
+                logger.info(f"{name}, {label}: "
+                            f"{EXECUTION_TIME.search(plan).group(1)} ms")
+                if args.verbose:
+                    logger.info(plan)
+
+    await close_postgres()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare EXPLAIN ANALYZE of the rating queries with the "
+                    "planner barred from the indexes and allowed to use them"
+    )
+    parser.add_argument("--seed", action="store_true",
+                        help="insert synthetic users, movies and ratings, "
+                             "meant for a local database only")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--movies", type=int, default=5000)
+    parser.add_argument("--ratings-per-user", type=int, default=50)
+    parser.add_argument("--verbose", action="store_true",
+                        help="log the full query plans")
+    args = parser.parse_args()
+
+    asyncio.run(benchmark_rating_indexes(args))
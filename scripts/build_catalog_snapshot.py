@@ -0,0 +1,39 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from recsys.common.database import close_redis
+from recsys.features.movies.catalog import (
+    prune_snapshots,
+    read_catalog,
+    save_catalog,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def build_catalog_snapshot(root: str, keep: int):
+    os.makedirs(root, exist_ok=True)
+
+    catalog = await read_catalog()
+    version = save_catalog(catalog, root)
+    logger.info(f"Snapshot {version} written with {len(catalog)} movies and "
+                f"{len(catalog.features)} features")
+
+    prune_snapshots(root, keep)
+    await close_redis()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a memory-mappable snapshot of the movie catalog"
+    )
+    parser.add_argument("--path", default=os.getenv("CATALOG_SNAPSHOT_DIR"),
+                        required=not os.getenv("CATALOG_SNAPSHOT_DIR"))
+    parser.add_argument("--keep", type=int, default=2,
+                        help="how many snapshot versions to keep on disk")
+    args = parser.parse_args()
+
+    asyncio.run(build_catalog_snapshot(args.path, max(args.keep, 1)))
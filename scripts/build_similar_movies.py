@@ -0,0 +1,44 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from recsys.common.database import close_redis
+from recsys.features.movies.catalog import get_catalog
+from recsys.features.movies.repository import store_similar_movies
+from recsys.features.movies.similarity import (
+    SIMILAR_BLOCK_CELLS,
+    similar_movies,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def build_similar_movies(k: int, block_cells: int):
+    catalog = await get_catalog()
+    started = time.perf_counter()
+    stored = 0
+
+    for neighbors in similar_movies(catalog, k, block_cells):
+        await store_similar_movies(neighbors)
+        stored += len(neighbors)
+        logger.info(f"{stored}/{len(catalog)} movies stored")
+
+    logger.info(f"Similar movies for {stored} movies built in "
+                f"{time.perf_counter() - started:.1f}s")
+    await close_redis()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the similar movies table from the catalog"
+    )
+    parser.add_argument("--top-k", type=int, default=int(os.getenv("TOP_N")))
+    parser.add_argument("--block-cells", type=int,
+                        default=SIMILAR_BLOCK_CELLS,
+                        help="movie pairs scored at once")
+    args = parser.parse_args()
+
+    asyncio.run(build_similar_movies(args.top_k, args.block_cells))
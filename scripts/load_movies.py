@@ -0,0 +1,145 @@
+import argparse
+import ast
+import asyncio
+import csv
+import logging
+import re
+import time
+from collections.abc import Iterator
+from itertools import islice
+
+from recsys.common.database import (
+    close_postgres,
+    close_redis,
+    postgres_client,
+)
+from recsys.features.movies.repository import bump_catalog_generation
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("title", "genres", "actors", "directors")
+QUOTED = re.compile(r"'([^'\\]*)'|\"([^\"\\]*)\"")
+
+MovieRecord = tuple[str, list[str] | None, list[str] | None,
+                    list[str] | None]
+
+
+def parse_list(value: str) -> list[str] | None:
+    # the dataset stores python list reprs, a regex over the quoted items
+    # is much cheaper than literal_eval and only escapes need the slow path
+    if not value:
+        return None
+
+    if "\\" in value:
+        items = ast.literal_eval(value)
+    else:
+        items = [single or double
+                 for single, double in QUOTED.findall(value)]
+
+    return [item.strip() for item in items] or None
+
+
+def read_movies(path: str, skip: int) -> Iterator[MovieRecord]:
+    with open(path, newline="", encoding="utf-8") as dataset:
+        reader = csv.reader(dataset)
+        header = next(reader)
+        positions = [header.index(column) for column in COLUMNS]
+
+        for row in islice(reader, skip, None):
+            title, genres, actors, directors = (row[position]
+                                                for position in positions)
+            yield (title, parse_list(genres), parse_list(actors),
+                   parse_list(directors))
+
+
+CHECKPOINT_QUERY = """
+    INSERT INTO movieload (source, loaded) VALUES ($1, $2)
+    ON CONFLICT (source) DO UPDATE SET loaded = excluded.loaded
+"""
+
+
+async def read_checkpoint(driver, source: str) -> int:
+    loaded = await driver.fetchval(
+        "SELECT loaded FROM movieload WHERE source = $1", source
+    )
+    return loaded or 0
+
+
+async def copy_movies(driver, path: str, chunk_size: int, source: str) -> int:
+    loaded = await read_checkpoint(driver, source)
+    if loaded:
+        logger.info(f"Resuming after {loaded} movies")
+
+    movies = read_movies(path, loaded)
+    started = time.perf_counter()
+    copied = 0
+
+    while chunk := list(islice(movies, chunk_size)):
+        # the checkpoint commits along with the chunk, so a crash never
+        # copies a chunk twice
+        async with driver.transaction():
+            await driver.copy_records_to_table(
+                "movie", records=chunk, columns=COLUMNS
+            )
+            await driver.execute(CHECKPOINT_QUERY, source,
+                                 loaded + len(chunk))
+        loaded += len(chunk)
+        copied += len(chunk)
+
+        elapsed = time.perf_counter() - started
+        logger.info(f"{loaded} movies loaded, "
+                    f"{copied / elapsed:.0f} rows/s")
+
+    return copied
+
+
+async def load_movies(path: str, chunk_size: int, source: str,
+                      restart: bool):
+    started = time.perf_counter()
+
+    try:
+        async with postgres_client.open().connect() as conn:
+            raw_connection = await conn.get_raw_connection()
+            driver = raw_connection.driver_connection
+
+            if restart:
+                # the rows copied before would be copied again
+                if await driver.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM movie)"
+                ):
+                    raise SystemExit("The movie table is not empty, empty "
+                                     "it before loading with --restart")
+                await driver.execute(
+                    "DELETE FROM movieload WHERE source = $1", source
+                )
+            copied = await copy_movies(driver, path, chunk_size, source)
+            await driver.execute("ANALYZE movie")
+    finally:
+        await close_postgres()
+
+    # running workers only rebuild their catalog once the generation moves
+    if copied:
+        await bump_catalog_generation()
+        await close_redis()
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"{copied} movies copied in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stream a movies CSV into Postgres with COPY"
+    )
+    parser.add_argument("--path", default="scripts/movies_dataset.csv")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--source",
+                        help="name the loaded rows are tracked under, "
+                             "defaults to the path")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore the checkpoint and load from the start, "
+                             "only into an empty movie table")
+    args = parser.parse_args()
+
+    asyncio.run(load_movies(args.path, args.chunk_size,
+                            args.source or args.path, args.restart))
@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor
+
+from recsys.common.database import close_redis
+from recsys.features.movies.catalog import Catalog, get_catalog
+from recsys.features.users import repository
+from recsys.features.users.application import (
+    generate_users_profiles,
+    get_users_infos,
+    recommend_users,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+worker_state: dict[str, Catalog] = {}
+
+
+def init_worker(catalog: Catalog):
+    worker_state["catalog"] = catalog
+
+
+def recommend_chunk(
+    user_ids: list[int],
+    movie_ratings: list[tuple[int, int, int]],
+    favorites: list[tuple[int, int, str]],
+    k: int
+) -> dict[int, tuple[list[int], list[float]]]:
+    catalog = worker_state["catalog"]
+    users_profiles, watched_matrix = generate_users_profiles(
+        catalog, user_ids, movie_ratings, favorites
+    )
+    users_recommendations = recommend_users(catalog, users_profiles,
+                                            watched_matrix, k)
+
+    return dict(zip(user_ids, users_recommendations))
+
+
+async def stream_chunks(chunk_size: int):
+    after_id = 0
+    while True:
+        user_ids = await repository.get_user_ids(after_id, chunk_size)
+        if not user_ids:
+            break
+
+        # read before the ratings, so users who write meanwhile keep their
+        # fresher recommendations
+        versions = await repository.get_recommendations_versions(user_ids)
+        movie_ratings, favorites = await get_users_infos(user_ids)
+        yield user_ids, versions, movie_ratings, favorites
+
+        after_id = user_ids[-1]
+
+
+async def store_chunks(chunks, versions: dict[int, str]) -> int:
+    users_recommendations = {}
+    for chunk in chunks:
+        users_recommendations.update(chunk.result())
+
+    # users who wrote since their ratings were read are skipped
+    return await repository.store_many_recommendations(
+        users_recommendations,
+        {user_id: versions.pop(user_id) for user_id in users_recommendations}
+    )
+
+
+async def precompute_recommendations(chunk_size: int, workers: int, k: int):
+    catalog = await get_catalog()
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    stored = 0
+    versions = {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(catalog,)) as executor:
+        pending = set()
+        async for (
+            user_ids, chunk_versions, movie_ratings, favorites
+        ) in stream_chunks(chunk_size):
+            versions.update(chunk_versions)
+            pending.add(loop.run_in_executor(
+                executor, recommend_chunk,
+                user_ids, movie_ratings, favorites, k
+            ))
+
+            if len(pending) >= workers * 2:
+                done, pending = await asyncio.wait(
+                    pending, return_when=FIRST_COMPLETED
+                )
+                stored += await store_chunks(done, versions)
+                logger.info(f"{stored} users stored "
+                            f"({stored / (time.perf_counter() - started):.0f}"
+                            " users/s)")
+
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            stored += await store_chunks(done, versions)
+
+    logger.info(f"Recommendations for {stored} users precomputed in "
+                f"{time.perf_counter() - started:.1f}s")
+    await close_redis()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute and cache recommendations for all users"
+    )
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--depth", type=int,
+        default=int(os.getenv("RECOMMENDATIONS_DEPTH", "200")),
+        help="how many ranked movies to keep per user"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(precompute_recommendations(args.chunk_size, args.workers,
+                                           args.depth))
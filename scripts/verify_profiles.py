@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import logging
+
+import numpy as np
+
+from recsys.common.database import close_redis
+from recsys.features.movies.catalog import feature_label, get_catalog
+from recsys.features.users import repository
+from recsys.features.users.application import (
+    generate_users_profiles,
+    get_users_infos,
+)
+from recsys.features.users.profile import GENERATION_FIELD, parse_profile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def verify_profiles(chunk_size: int, fix: bool):
+    catalog = await get_catalog()
+    checked = missing = inconsistent = 0
+
+    after_id = 0
+    while user_ids := await repository.get_user_ids(after_id, chunk_size):
+        movie_ratings, favorites = await get_users_infos(user_ids)
+        users_profiles, _ = generate_users_profiles(catalog, user_ids,
+                                                    movie_ratings, favorites)
+
+        users_favorites = {user_id: set() for user_id in user_ids}
+        for user_id, kind, name in favorites:
+            users_favorites[user_id].add(feature_label(kind, name))
+
+        for position, user_id in enumerate(user_ids):
+            stored_profile = await repository.get_profile(user_id)
+            # profiles of another catalog generation are never served
+            if (stored_profile is None or stored_profile.get(GENERATION_FIELD)
+                    != str(catalog.generation)):
+                missing += 1
+                continue
+
+            checked += 1
+            user_profile, stored_favorites = parse_profile(catalog,
+                                                           stored_profile)
+            expected = users_profiles[position].toarray().ravel()
+
+            if (not np.allclose(user_profile, expected)
+                    or stored_favorites != users_favorites[user_id]):
+                inconsistent += 1
+                logger.warning(f"User {user_id} profile is inconsistent")
+                if fix:
+                    await repository.delete_profile(user_id)
+
+        after_id = user_ids[-1]
+
+    logger.info(f"{checked} profiles checked, {inconsistent} inconsistent, "
+                f"{missing} not stored")
+    await close_redis()
+
+    return inconsistent
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check stored user profiles against a full recompute"
+    )
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--fix", action="store_true",
+                        help="drop inconsistent profiles so they get rebuilt")
+    args = parser.parse_args()
+
+    inconsistent = asyncio.run(verify_profiles(args.chunk_size, args.fix))
+    raise SystemExit(1 if inconsistent else 0)
@@ -1,6 +1,10 @@
+import asyncio
+
 from fastapi import status
 
-from recsys.common.security import get_password_hash
+from recsys.common.cache import LRUCache
+from recsys.common.security import PasswordSettings, get_password_hash
+from recsys.features.auth.application import invalidate_principal
 from recsys.features.users.model import User
 
 
@@ -39,3 +43,68 @@ def test_refresh_token(client, token):
     assert "access_token" in token
     assert "token_type" in token
     assert token["token_type"] == "bearer"
+
+
+def test_current_user_is_cached_until_invalidated(client, mocker, token):
+    mocker.patch("recsys.features.auth.application.principals",
+                 LRUCache(maxsize=10, ttl=30))
+    mocker.patch("recsys.features.auth.application.publish_invalidation")
+    get_user_by_email = mocker.patch(
+        "recsys.features.auth.application.get_user_by_email",
+        return_value=User(id=1, name="test", email="test@test.com",
+                          password="hash")
+    )
+
+    for _ in range(3):
+        response = client.post(
+            "/auth/refresh-token",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+    asyncio.run(invalidate_principal("test@test.com"))
+    client.post("/auth/refresh-token",
+                headers={"Authorization": f"Bearer {token}"})
+
+    assert get_user_by_email.call_args_list == [
+        mocker.call("test@test.com")
+    ] * 2
+
+
+def test_token_for_another_user_id_is_rejected(client, mocker, token):
+    mocker.patch("recsys.features.auth.application.principals",
+                 LRUCache(maxsize=10, ttl=30))
+    mocker.patch("recsys.features.auth.application.get_user_by_email",
+                 return_value=User(id=2, name="test", email="test@test.com",
+                                   password="hash"))
+
+    response = client.post(
+        "/auth/refresh-token",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_login_is_rejected_when_password_checks_are_saturated(client,
+                                                              mocker):
+    mocker.patch("recsys.features.auth.application.get_user_by_email",
+                 return_value=User(
+                                   id=1, name="test",
+                                   email="test@test.com",
+                                   password=get_password_hash("abc123")
+                               ))
+    mocker.patch("recsys.common.security.password_settings",
+                 return_value=PasswordSettings(rounds=4, workers=1,
+                                               queue_limit=0))
+
+    response = client.post(
+        "/auth/token",
+        json={
+            "email": "test@test.com",
+            "password": "abc123"
+        }
+    )
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "1"
@@ -0,0 +1,35 @@
+from fastapi import status
+
+from recsys.common import metrics
+from recsys.common.cache import LRUCache
+
+
+def test_lru_cache_evicts_and_expires(mocker):
+    monotonic = mocker.patch("recsys.common.cache.time.monotonic",
+                             return_value=0)
+    cache = LRUCache(maxsize=2, ttl=10)
+
+    cache.set(1, "a")
+    cache.set(2, "b")
+    cache.get(1)
+    cache.set(3, "c")
+
+    assert (cache.get(1), cache.get(2), cache.get(3)) == ("a", None, "c")
+
+    monotonic.return_value = 10
+
+    assert cache.get(1) is None
+    assert len(cache) == 1
+
+
+def test_get_metrics(client, mocker):
+    mocker.patch.dict(metrics.counters, clear=True)
+    metrics.increment("recsys_cache_requests_total", tier="local",
+                      result="hit")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.text == (
+        'recsys_cache_requests_total{result="hit",tier="local"} 1\n'
+    )
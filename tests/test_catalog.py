@@ -0,0 +1,157 @@
+import asyncio
+import pickle
+
+from recsys.features.movies.catalog import (
+    ACTOR,
+    CatalogLoader,
+    build_catalog,
+    current_snapshot,
+    load_catalog,
+    save_catalog,
+)
+from recsys.features.movies.model import Movie
+from recsys.features.movies.similarity import similar_movies
+
+
+def make_movies():
+    return [
+        Movie(id=1, title="Awesome movie", genres=["Action", "Drama"],
+              actors=["DiCaprio"], directors=["Martin Scorsese"]),
+        Movie(id=2, title="Foobar the movie", genres=["Drama"],
+              actors=[" DiCaprio", "Pitt"], directors=None),
+        Movie(id=5, title="Another movie", genres=["Comedy"],
+              actors=None, directors=["Martin Scorsese"]),
+    ]
+
+
+def test_build_catalog():
+    catalog = build_catalog(make_movies())
+
+    assert catalog.movie_ids.tolist() == [1, 2, 5]
+    assert catalog.features == [
+        "Action", "Drama", "DiCaprio", "Martin Scorsese", "Pitt", "Comedy"
+    ]
+    assert catalog.matrix.toarray().tolist() == [
+        [1, 1, 1, 1, 0, 0],
+        [0, 1, 1, 0, 1, 0],
+        [0, 0, 0, 1, 0, 1],
+    ]
+    assert catalog.rows_of([5, 3, 1]).tolist() == [2, -1, 0]
+
+
+def test_catalog_feature_mask():
+    catalog = build_catalog(make_movies())
+
+    mask = catalog.feature_mask(["Pitt", "Unknown"], [])
+
+    assert mask.tolist() == [True, True, False, False, True, True]
+
+
+def test_catalog_movie():
+    catalog = build_catalog(make_movies())
+
+    movie = catalog.movie(2)
+
+    assert movie.model_dump() == {
+        "id": 2,
+        "title": "Foobar the movie",
+        "genres": ["Drama"],
+        "actors": ["DiCaprio", "Pitt"],
+        "directors": None
+    }
+
+
+def test_catalog_snapshot(tmp_path):
+    catalog = build_catalog(make_movies())
+    save_catalog(catalog, str(tmp_path))
+
+    snapshot = load_catalog(current_snapshot(str(tmp_path)))
+
+    assert not snapshot.matrix.indices.flags.writeable
+    assert list(snapshot.features) == catalog.features
+    assert snapshot.rows_of([5, 3, 1]).tolist() == [2, -1, 0]
+    assert snapshot.column(ACTOR, "Pitt") == catalog.column(ACTOR, "Pitt")
+    assert snapshot.movie(2) == catalog.movie(2)
+    assert pickle.loads(pickle.dumps(snapshot)).path == snapshot.path
+
+
+def test_catalog_loader_follows_generation(mocker):
+    movies = make_movies()
+    mocker.patch("recsys.features.movies.catalog.get_catalog_generation",
+                 side_effect=[0, 0, 1])
+    mocker.patch("recsys.features.movies.catalog.get_all_movies",
+                 side_effect=[movies, movies[:2]])
+    loader = CatalogLoader()
+
+    async def load_twice():
+        first = await loader.get()
+        loader.delete(1)
+        assert loader.current() is None
+        return first, await loader.get()
+
+    first, second = asyncio.run(load_twice())
+
+    assert (len(first), first.generation) == (3, 0)
+    assert (len(second), second.generation) == (2, 1)
+    assert loader.current() is second
+
+
+def test_outdated_catalog_snapshot_is_rebuilt(tmp_path, mocker,
+                                              monkeypatch):
+    outdated = build_catalog(make_movies())
+    outdated.generation = 0
+    save_catalog(outdated, str(tmp_path))
+    monkeypatch.setenv("CATALOG_SNAPSHOT_DIR", str(tmp_path))
+    mocker.patch("recsys.features.movies.catalog.get_catalog_generation",
+                 return_value=1)
+    mocker.patch("recsys.features.movies.catalog.get_all_movies",
+                 return_value=make_movies()[:1])
+    mocker.patch("recsys.features.movies.catalog.lock_catalog_snapshot",
+                 return_value=True)
+    mocker.patch("recsys.features.movies.catalog.unlock_catalog_snapshot")
+    loader = CatalogLoader()
+
+    async def load_until_rebuilt():
+        served = await loader.get()
+        while current_snapshot(str(tmp_path)) == served.path:
+            await asyncio.sleep(0.01)
+        return served, await loader.get()
+
+    served, rebuilt = asyncio.run(load_until_rebuilt())
+
+    assert (len(served), served.generation) == (3, 0)
+    assert (len(rebuilt), rebuilt.generation) == (1, 1)
+    assert loader.current() is rebuilt
+
+
+def test_similar_movies():
+    catalog = build_catalog(make_movies())
+
+    blocks = list(similar_movies(catalog, k=1, block_cells=6))
+    whole = list(similar_movies(catalog, k=1))
+
+    assert blocks == [{1: [2], 2: [1]}, {5: [1]}]
+    assert whole == [{1: [2], 2: [1], 5: [1]}]
+
+
+def test_snapshot_lock_held_elsewhere_is_not_asked_for_again(tmp_path,
+                                                             mocker,
+                                                             monkeypatch):
+    outdated = build_catalog(make_movies())
+    outdated.generation = 0
+    save_catalog(outdated, str(tmp_path))
+    monkeypatch.setenv("CATALOG_SNAPSHOT_DIR", str(tmp_path))
+    mocker.patch("recsys.features.movies.catalog.get_catalog_generation",
+                 return_value=1)
+    lock = mocker.patch("recsys.features.movies.catalog.lock_catalog_snapshot",
+                        return_value=False)
+    loader = CatalogLoader()
+
+    async def load_often():
+        for _ in range(3):
+            await loader.get()
+            await asyncio.sleep(0.01)
+
+    asyncio.run(load_often())
+
+    lock.assert_called_once()
@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, status
+
+from recsys.common import metrics
+from recsys.common.database import PostgresClient
+
+
+def test_busy_database_is_rejected(mocker):
+    mocker.patch.dict(metrics.counters, clear=True)
+    mocker.patch.dict("os.environ", {"POSTGRES_MAX_CONCURRENCY": "0",
+                                     "POSTGRES_POOL_TIMEOUT": "0.01"})
+    client = PostgresClient()
+
+    async def connect():
+        try:
+            async with client.session():
+                pass
+        finally:
+            await client.close()
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(connect())
+
+    assert error.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert metrics.counters[
+        "recsys_db_pool_exhausted_total", (("stage", "bulkhead"),)
+    ] == 1
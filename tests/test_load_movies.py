@@ -0,0 +1,144 @@
+import ast
+import asyncio
+import csv
+from contextlib import asynccontextmanager
+
+import pytest
+
+from recsys.features.movies.application import movies_to_csv
+from recsys.features.movies.model import Movie
+from scripts.load_movies import (
+    CHECKPOINT_QUERY,
+    COLUMNS,
+    copy_movies,
+    load_movies,
+    parse_list,
+    read_movies,
+)
+
+DATASET = "scripts/movies_dataset.csv"
+
+
+class FakeDriver:
+    # keeps copied rows and the checkpoint like a transaction would
+    def __init__(self, fail_at: int | None = None):
+        self.movies = []
+        self.loaded = 0
+        self.fail_at = fail_at
+        self._staged = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        self._staged = {"movies": [], "loaded": self.loaded}
+        try:
+            yield
+        finally:
+            staged, self._staged = self._staged, None
+
+        self.movies.extend(staged["movies"])
+        self.loaded = staged["loaded"]
+
+    async def fetchval(self, query, source):
+        return self.loaded or None
+
+    async def copy_records_to_table(self, table, records, columns):
+        self._staged["movies"].extend(records)
+
+    async def execute(self, query, *args):
+        if query != CHECKPOINT_QUERY:
+            return
+
+        _, loaded = args
+        if loaded == self.fail_at:
+            raise ConnectionError
+        self._staged["loaded"] = loaded
+
+
+def write_dataset(path, titles):
+    with open(path, "w", newline="", encoding="utf-8") as dataset:
+        writer = csv.writer(dataset)
+        writer.writerow(("", "title", "directors", "actors", "genres"))
+        for position, title in enumerate(titles):
+            writer.writerow((position, title, "['Someone']", "", "['Drama']"))
+
+
+def test_parse_list():
+    assert parse_list("") is None
+    assert parse_list("[]") is None
+    assert parse_list("['Drama', ' Comedies']") == ["Drama", "Comedies"]
+    assert parse_list("[\"Jon O'Brien\"]") == ["Jon O'Brien"]
+    assert parse_list("['It\\'s', 'Me']") == ["It's", "Me"]
+
+
+def test_parse_list_matches_literal_eval():
+    with open(DATASET, newline="", encoding="utf-8") as dataset:
+        for row in csv.DictReader(dataset):
+            for column in COLUMNS[1:]:
+                expected = ([item.strip()
+                             for item in ast.literal_eval(row[column])]
+                            if row[column] else None)
+                assert parse_list(row[column]) == (expected or None)
+
+
+def test_read_movies_skips_loaded_rows(tmp_path):
+    path = tmp_path / "movies.csv"
+    write_dataset(path, ["First", "Second", "Third"])
+
+    assert list(read_movies(path, 1)) == [
+        ("Second", ["Drama"], None, ["Someone"]),
+        ("Third", ["Drama"], None, ["Someone"]),
+    ]
+
+
+def test_copy_movies_resumes_without_duplicates(tmp_path):
+    path = tmp_path / "movies.csv"
+    titles = [f"Movie {position}" for position in range(5)]
+    write_dataset(path, titles)
+    chunk_size = 2
+    # dies while committing the second chunk
+    driver = FakeDriver(fail_at=2 * chunk_size)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(copy_movies(driver, path, chunk_size, "movies"))
+    assert driver.loaded == chunk_size
+
+    driver.fail_at = None
+    copied = asyncio.run(copy_movies(driver, path, chunk_size, "movies"))
+
+    assert copied == len(titles) - chunk_size
+    assert driver.loaded == len(titles)
+    assert [title for title, *_ in driver.movies] == titles
+
+
+def test_load_movies_moves_catalog_generation_once(mocker, tmp_path):
+    path = tmp_path / "movies.csv"
+    write_dataset(path, ["First", "Second", "Third"])
+    driver = FakeDriver()
+    conn = mocker.AsyncMock()
+    conn.get_raw_connection.return_value.driver_connection = driver
+    client = mocker.patch("scripts.load_movies.postgres_client")
+    client.open.return_value.connect.return_value.__aenter__.return_value = (
+        conn
+    )
+    mocker.patch("scripts.load_movies.close_postgres")
+    mocker.patch("scripts.load_movies.close_redis")
+    bump_catalog_generation = mocker.patch(
+        "scripts.load_movies.bump_catalog_generation"
+    )
+
+    asyncio.run(load_movies(path, 2, "movies", False))
+
+    assert len(driver.movies) == driver.loaded
+    bump_catalog_generation.assert_called_once_with()
+
+
+def test_read_movies_reads_the_csv_export(tmp_path):
+    path = tmp_path / "export.csv"
+    path.write_text(movies_to_csv([
+        Movie(id=1, title="Awesome movie", genres=["Drama", "Comédie"],
+              actors=['Jon "J" O\'Brien'], directors=None),
+    ], header=True), encoding="utf-8")
+
+    assert list(read_movies(path, 0)) == [
+        ("Awesome movie", ["Drama", "Comédie"], ['Jon "J" O\'Brien'], None),
+    ]
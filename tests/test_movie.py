@@ -1,7 +1,19 @@
+import asyncio
+import csv
+import io
+import json
+
 from fastapi import status
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
 
-from recsys.features.movies.model import MoviePublic
-from recsys.features.ratings.model import RatingPublic
+from recsys.common.pagination import encode_cursor
+from recsys.features.movies import application
+from recsys.features.movies.catalog import build_catalog
+from recsys.features.movies.model import Movie, MovieFilter, MoviePublic
+from recsys.features.movies.repository import filter_movies
+from recsys.features.ratings.model import RatingBase, RatingPublic
 
 
 def test_get_movies(client, mocker, token):
@@ -26,6 +38,117 @@ def test_get_movies(client, mocker, token):
     }]
 
 
+def test_get_movies_after_cursor(client, mocker, token):
+    get_movies = mocker.patch(
+        "recsys.features.movies.application.get_movies",
+        return_value=[
+            MoviePublic(id=movie_id, title="Awesome movie",
+                        genres=["Action"], actors=None, directors=None)
+            for movie_id in (11, 12)
+        ]
+    )
+    response = client.get(
+        "/movies",
+        params={"cursor": encode_cursor(10), "limit": 2},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["X-Next-Cursor"] == encode_cursor(12)
+    get_movies.assert_called_once_with(0, 2, 10, MovieFilter())
+
+
+def test_get_movies_filtered_by_features(client, mocker, token):
+    get_movies = mocker.patch(
+        "recsys.features.movies.application.get_movies", return_value=[]
+    )
+    response = client.get(
+        "/movies",
+        params={"genre": ["Drama", "Action"], "actor": "Pitt",
+                "match": "any"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    get_movies.assert_called_once_with(
+        0, 100, None,
+        MovieFilter(genres=["Drama", "Action"], actors=["Pitt"],
+                    match="any")
+    )
+
+
+def test_filter_movies_uses_array_operators():
+    def where_clause(filters):
+        query = filter_movies(select(Movie), filters)
+        return str(query.compile(dialect=postgresql.dialect())
+                   ).split("WHERE")[1]
+
+    contains = where_clause(MovieFilter(genres=["Drama"],
+                                        directors=["Martin Scorsese"]))
+    overlaps = where_clause(MovieFilter(actors=["Pitt"], match="any"))
+
+    assert "movie.genres @>" in contains
+    assert "movie.directors @>" in contains
+    assert "movie.actors &&" in overlaps
+    assert "genres" not in overlaps
+
+
+def test_get_movies_with_invalid_cursor(client, token):
+    response = client.get(
+        "/movies",
+        params={"cursor": "not-a-cursor"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json() == {"detail": "Invalid cursor"}
+
+
+def export_batches(mocker):
+    async def stream_movies(batch_size):
+        yield [Movie(id=1, title="Awesome movie", genres=["Action"],
+                     actors=["DiCaprio"], directors=None)]
+        yield [Movie(id=2, title="Another, movie", genres=["Drama"],
+                     actors=None, directors=["Martin Scorsese"])]
+
+    mocker.patch("recsys.features.movies.repository.stream_movies",
+                 stream_movies)
+
+
+def test_export_movies_as_ndjson(client, mocker, token):
+    export_batches(mocker)
+    response = client.get(
+        "/movies/export",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"id": 1, "title": "Awesome movie", "genres": ["Action"],
+         "actors": ["DiCaprio"], "directors": None},
+        {"id": 2, "title": "Another, movie", "genres": ["Drama"],
+         "actors": None, "directors": ["Martin Scorsese"]},
+    ]
+
+
+def test_export_movies_as_csv(client, mocker, token):
+    export_batches(mocker)
+    response = client.get(
+        "/movies/export",
+        params={"format": "csv"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/csv")
+    assert list(csv.reader(io.StringIO(response.text))) == [
+        ["id", "title", "genres", "actors", "directors"],
+        ["1", "Awesome movie", '["Action"]', '["DiCaprio"]', ""],
+        ["2", "Another, movie", '["Drama"]', "", '["Martin Scorsese"]'],
+    ]
+
+
 def test_get_movie(client, mocker, token):
     mocker.patch("recsys.features.movies.application.get_movie",
                  return_value=MoviePublic(id=1,
@@ -153,3 +276,120 @@ def test_post_movie_ratings(client, mocker, token):
         "movie_id": 1,
         "rating": 4
     }
+
+
+def test_post_movie_rating_twice(client, mocker, token):
+    class UniqueViolation(Exception):
+        pgcode = "23505"
+
+    mocker.patch("recsys.features.movies.repository.get_movie",
+                 return_value=Movie(id=1, title="Awesome movie",
+                                    genres=["Action"]))
+    mocker.patch("recsys.features.movies.application.bump_profile_version")
+    mocker.patch("recsys.features.movies.repository.create_movie_rating",
+                 return_value=IntegrityError("INSERT", {},
+                                             UniqueViolation()))
+    response = client.post(
+        "/movies/1/ratings",
+        headers={"Authorization": f"Bearer {token}"},
+        json={"rating": 4}
+    )
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json() == {"detail": "Movie already rated"}
+
+
+def test_rating_delta_is_applied_against_version_bumped_first(mocker):
+    # a recompute that reads the ratings after this write, and stores
+    # before the delta, has to find the version moved on
+    calls = mocker.Mock()
+    catalog = build_catalog([Movie(id=1, title="Awesome movie",
+                                   genres=["Action"], actors=None,
+                                   directors=None)])
+    mocker.patch("recsys.features.movies.repository.get_movie",
+                 return_value=Movie(id=1, title="Awesome movie",
+                                    genres=["Action"]))
+    mocker.patch("recsys.features.users.profile.get_catalog",
+                 return_value=catalog)
+    mocker.patch("recsys.features.movies.application.delete_recommendations")
+    calls.attach_mock(mocker.patch(
+        "recsys.features.movies.application.bump_profile_version",
+        return_value="4"
+    ), "bump_profile_version")
+    calls.attach_mock(mocker.patch(
+        "recsys.features.movies.repository.create_movie_rating",
+        return_value=RatingPublic(id=1, user_id=1, movie_id=1, rating=4)
+    ), "create_movie_rating")
+    calls.attach_mock(mocker.patch(
+        "recsys.features.users.repository.increment_profile"
+    ), "increment_profile")
+
+    asyncio.run(application.create_movie_rating(1, 1, RatingBase(rating=4)))
+
+    assert [call[0] for call in calls.mock_calls] == [
+        "bump_profile_version", "create_movie_rating", "increment_profile"
+    ]
+    calls.increment_profile.assert_called_once_with(
+        1, ["genre:Action"], 4, "4", str(catalog.generation)
+    )
+
+
+def test_get_similar_movies(client, mocker, token):
+    mocker.patch("recsys.features.movies.repository.get_similar_movies",
+                 return_value=[2])
+    mocker.patch("recsys.features.movies.application.get_catalog")
+    mocker.patch("recsys.features.movies.application.get_movies_by_ids",
+                 return_value=[
+                     MoviePublic(id=2, title="Foobar the movie",
+                                 genres=["Drama"], actors=None,
+                                 directors=None)
+                 ])
+    response = client.get(
+        "/movies/1/similar",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == [{
+        "id": 2,
+        "title": "Foobar the movie",
+        "genres": ["Drama"],
+        "actors": None,
+        "directors": None
+    }]
+
+
+def test_get_movies_by_ids(mocker):
+    catalog = build_catalog([
+        Movie(id=1, title="Awesome movie", genres=["Action"],
+              actors=["DiCaprio"], directors=["Martin Scorsese"]),
+        Movie(id=2, title="Foobar the movie", genres=["Drama"],
+              actors=None, directors=None),
+    ])
+    mocker.patch.object(application.catalog_loader, "current",
+                        return_value=catalog)
+    get_movies_by_ids = mocker.patch(
+        "recsys.features.movies.repository.get_movies_by_ids",
+        return_value=[Movie(id=3, title="Another movie", genres=["Comedy"],
+                            actors=None, directors=None)]
+    )
+
+    movies = asyncio.run(application.get_movies_by_ids([3, 2, 4, 1]))
+
+    assert [movie.id for movie in movies] == [3, 2, 1]
+    get_movies_by_ids.assert_called_once_with([3, 4])
+
+
+def test_get_movies_by_ids_skips_outdated_catalog(mocker):
+    mocker.patch.object(application.catalog_loader, "current",
+                        return_value=None)
+    get_movies_by_ids = mocker.patch(
+        "recsys.features.movies.repository.get_movies_by_ids",
+        return_value=[Movie(id=1, title="Renamed movie", genres=["Action"],
+                            actors=None, directors=None)]
+    )
+
+    movies = asyncio.run(application.get_movies_by_ids([2, 1]))
+
+    assert [movie.title for movie in movies] == ["Renamed movie"]
+    get_movies_by_ids.assert_called_once_with([2, 1])
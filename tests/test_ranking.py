@@ -0,0 +1,26 @@
+import numpy as np
+
+from recsys.common.ranking import top_k
+
+
+def test_top_k():
+    scores = np.array([0.5, 0.9, 0.1, 0.9, 0.3, np.nan, 0.7])
+    ids = np.array([16, 13, 12, 11, 14, 15, 10])
+
+    assert top_k(scores, ids, 3).tolist() == [3, 1, 6]
+    assert top_k(scores, ids, 10).tolist() == [3, 1, 6, 0, 4, 2]
+
+
+def test_top_k_excluded():
+    scores = np.array([0.5, 0.9, 0.1, 0.9, 0.3, np.nan, 0.7])
+    ids = np.array([16, 13, 12, 11, 14, 15, 10])
+    excluded = np.array([False, False, False, True, False, False, False])
+
+    assert top_k(scores, ids, 2, excluded=excluded).tolist() == [1, 6]
+
+
+def test_top_k_ties():
+    scores = np.array([1.0, 1.0, 1.0, 1.0, 2.0])
+    ids = np.array([40, 30, 20, 10, 50])
+
+    assert top_k(scores, ids, 3).tolist() == [4, 3, 2]
@@ -1,6 +1,13 @@
-from fastapi import status
+import asyncio
+from contextlib import asynccontextmanager
 
-from recsys.features.ratings.model import Rating, RatingPublic
+import pytest
+from fastapi import HTTPException, status
+
+from recsys.features.movies.model import Movie
+from recsys.features.ratings import application
+from recsys.features.ratings.buffer import RatingBuffer, rating_buffer
+from recsys.features.ratings.model import Rating, RatingPublic, RatingUpdate
 
 
 def test_get_ratings(client, mocker, token):
@@ -21,6 +28,16 @@ def test_get_ratings(client, mocker, token):
     }]
 
 
+def test_get_ratings_passes_page(mocker):
+    get_ratings = mocker.patch(
+        "recsys.features.ratings.repository.get_ratings", return_value=[]
+    )
+
+    asyncio.run(application.get_ratings(0, 50, 7))
+
+    get_ratings.assert_called_once_with(0, 50, 7)
+
+
 def test_update_rating(client, mocker, token):
     mocker.patch("recsys.features.ratings.application.get_rating",
                  return_value=Rating(id=1, user_id=1,
@@ -58,3 +75,145 @@ def test_delete_rating(client, mocker, token):
 
     assert response.status_code == status.HTTP_200_OK
     assert response.json() == {"message": "Rating deleted"}
+
+
+def test_update_rating_invalidates_recommendations(mocker):
+    mocker.patch("recsys.features.ratings.repository.update_rating",
+                 return_value=Rating(id=1, user_id=1, movie_id=2, rating=3))
+    delete_profile = mocker.patch(
+        "recsys.features.ratings.application.delete_profile"
+    )
+    delete_recommendations = mocker.patch(
+        "recsys.features.ratings.application.delete_recommendations"
+    )
+
+    asyncio.run(application.update_rating(
+        Rating(id=1, user_id=1, movie_id=2, rating=5), RatingUpdate(rating=3)
+    ))
+
+    delete_profile.assert_called_once_with(1)
+    delete_recommendations.assert_called_once_with(1)
+
+
+def test_post_movie_rating_is_queued_in_write_behind_mode(client, mocker,
+                                                          token):
+    mocker.patch.object(rating_buffer, "enabled", True)
+    put = mocker.patch.object(rating_buffer, "put")
+    mocker.patch("recsys.features.movies.repository.get_movie",
+                 return_value=Movie(id=1, title="Awesome movie",
+                                    genres=["Action"]))
+
+    response = client.post(
+        "/movies/1/ratings",
+        headers={"Authorization": f"Bearer {token}"},
+        json={"rating": 4}
+    )
+
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.json() == {"user_id": 1, "movie_id": 1, "rating": 4}
+    put.assert_called_once_with(1, 1, 4)
+
+
+def mock_buffer_redis(mocker):
+    conn = mocker.AsyncMock()
+    conn.queue = mocker.AsyncMock()
+    conn.register_script = mocker.Mock(return_value=conn.queue)
+
+    @asynccontextmanager
+    async def redis_connection():
+        yield conn
+
+    mocker.patch("recsys.features.ratings.buffer.redis_connection",
+                 redis_connection)
+    mocker.patch("recsys.features.ratings.buffer.delete_profile")
+    mocker.patch("recsys.features.ratings.buffer.delete_recommendations")
+    return conn
+
+
+def test_buffered_ratings_are_flushed_with_backpressure(mocker):
+    conn = mock_buffer_redis(mocker)
+    conn.queue.side_effect = ["1-0", "1-1", "1-2"]
+    insert_ratings = mocker.patch(
+        "recsys.features.ratings.repository.insert_ratings", return_value=2
+    )
+    buffer = RatingBuffer(enabled=True, maxsize=2, batch_size=10,
+                          flush_interval=1, put_timeout=0.01)
+
+    async def rate():
+        await buffer.put(1, 10, 3)
+        await buffer.put(1, 11, 5)
+        with pytest.raises(HTTPException) as error:
+            await buffer.put(2, 11, 4)
+        assert error.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+        assert await buffer.flush()
+        await buffer.put(2, 11, 4)
+
+    asyncio.run(rate())
+
+    assert list(insert_ratings.call_args.args[0]) == [(1, 10, 3), (1, 11, 5)]
+    conn.xdel.assert_called_once_with("ratings:buffer", "1-0", "1-1")
+    conn.delete.assert_called_once_with("ratings:pending:1:10",
+                                        "ratings:pending:1:11")
+    assert len(buffer) == 1
+
+
+def test_buffered_rating_of_queued_movie_is_rejected(mocker):
+    conn = mock_buffer_redis(mocker)
+    # the movie is claimed by a rating still waiting in a buffer
+    conn.queue.return_value = None
+    buffer = RatingBuffer(enabled=True, maxsize=1, batch_size=10,
+                          flush_interval=1, put_timeout=0.01)
+
+    async def rate():
+        for _ in range(2):
+            with pytest.raises(HTTPException) as error:
+                await buffer.put(1, 10, 3)
+            assert error.value.status_code == status.HTTP_400_BAD_REQUEST
+            assert error.value.detail == "Movie already rated"
+
+    asyncio.run(rate())
+
+    conn.queue.assert_called_with(
+        keys=["ratings:buffer", "ratings:pending:1:10"],
+        args=[1, 10, 3, 3600]
+    )
+    assert len(buffer) == 0
+
+
+def test_failed_buffered_rating_frees_its_slot(mocker):
+    conn = mock_buffer_redis(mocker)
+    conn.queue.side_effect = [ConnectionError, "1-0"]
+    buffer = RatingBuffer(enabled=True, maxsize=1, batch_size=10,
+                          flush_interval=1, put_timeout=0.01)
+
+    async def rate():
+        with pytest.raises(ConnectionError):
+            await buffer.put(1, 10, 3)
+        await buffer.put(1, 10, 3)
+
+    asyncio.run(rate())
+
+    assert len(buffer) == 1
+
+
+def test_recover_replays_entries_of_other_workers(mocker):
+    conn = mock_buffer_redis(mocker)
+    conn.set.return_value = True
+    conn.xrange.return_value = [
+        ("1-0", {"user_id": "1", "movie_id": "10", "rating": "3"}),
+        ("1-1", {"user_id": "2", "movie_id": "11", "rating": "4"}),
+        ("1-2", {"user_id": "2", "movie_id": "11", "rating": "1"}),
+    ]
+    insert_ratings = mocker.patch(
+        "recsys.features.ratings.repository.insert_ratings", return_value=1
+    )
+    buffer = RatingBuffer(enabled=True, maxsize=2, batch_size=10,
+                          flush_interval=1, put_timeout=0.01)
+    buffer._pending.append(("1-0", 1, 10, 3))
+
+    asyncio.run(buffer.recover())
+
+    assert list(insert_ratings.call_args.args[0]) == [(2, 11, 4)]
+    conn.xdel.assert_called_once_with("ratings:buffer", "1-1", "1-2")
+    assert len(buffer) == 1
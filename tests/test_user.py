@@ -1,6 +1,33 @@
+import asyncio
+import json
+import zlib
+
+import numpy as np
 from fastapi import status
 
+from recsys.common.cache import LRUCache
+from recsys.features.movies.catalog import ACTOR, build_catalog
+from recsys.features.movies.model import Movie
+from recsys.features.users.application import (
+    cached_recommendation,
+    generate_recommendation,
+    generate_user_profile,
+    generate_users_profiles,
+    ranked_page,
+    recommend_users,
+    remove_watcheds_and_sort_recommendations,
+    user_recommendation,
+)
 from recsys.features.users.model import UserPublic
+from recsys.features.users.profile import (
+    get_user_profile,
+    parse_profile,
+    profile_values,
+)
+from recsys.features.users.repository import (
+    pack_recommendations,
+    unpack_recommendations,
+)
 
 
 def test_get_users(client, mocker, token):
@@ -132,3 +159,326 @@ def test_user_ratings(client, mocker, token):
         "title": "Awesome movie",
         "rating": 4
     }]
+
+
+def test_bulk_user_ratings(client, mocker, token):
+    mocker.patch("recsys.features.users.repository.get_existing_movie_ids",
+                 return_value={1, 2, 3})
+    upsert_ratings = mocker.patch(
+        "recsys.features.users.repository.upsert_ratings",
+        return_value={1: True, 2: False}
+    )
+    delete_profile = mocker.patch(
+        "recsys.features.users.repository.delete_profile"
+    )
+    delete_recommendations = mocker.patch(
+        "recsys.features.users.repository.delete_recommendations"
+    )
+    response = client.post(
+        "/users/ratings/bulk",
+        headers={"Authorization": f"Bearer {token}"},
+        json={"ratings": [
+            {"movie_id": 1, "rating": 2},
+            {"movie_id": 1, "rating": 4},
+            {"movie_id": 2, "rating": 3},
+            {"movie_id": 3, "rating": 5},
+            {"movie_id": 4, "rating": 1},
+            {"movie_id": 5, "rating": 9},
+        ]}
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert [item["status"] for item in response.json()] == [
+        "duplicate", "created", "updated", "unchanged", "movie_not_found",
+        "invalid_rating",
+    ]
+    upsert_ratings.assert_called_once_with(1, {1: 4, 2: 3, 3: 5})
+    delete_profile.assert_called_once_with(1)
+    delete_recommendations.assert_called_once_with(1)
+
+
+def make_catalog():
+    return build_catalog([
+        Movie(id=1, title="Awesome movie", genres=["Action", "Drama"],
+              actors=["DiCaprio"], directors=["Martin Scorsese"]),
+        Movie(id=2, title="Foobar the movie", genres=["Drama"],
+              actors=["DiCaprio", "Pitt"], directors=None),
+        Movie(id=3, title="Another movie", genres=["Comedy"],
+              actors=None, directors=["Martin Scorsese"]),
+        Movie(id=4, title="Yet another movie", genres=["Action"],
+              actors=["Pitt"], directors=None),
+    ])
+
+
+def test_generate_user_profile():
+    catalog = make_catalog()
+    rated_rows = catalog.rows_of([1, 2])
+    feature_mask = catalog.feature_mask(["DiCaprio"], [])
+
+    user_profile = generate_user_profile(catalog, rated_rows,
+                                         np.array([4, 2]), feature_mask)
+
+    assert user_profile.tolist() == [4, 6, 6, 0, 0, 0]
+
+
+def test_recommend_users_matches_single_user():
+    catalog = make_catalog()
+    movie_ratings = [(10, 1, 4), (10, 2, 2), (20, 3, 5)]
+    favorites = [(10, ACTOR, "Pitt")]
+
+    users_profiles, watched_matrix = generate_users_profiles(
+        catalog, [10, 20, 30], movie_ratings, favorites
+    )
+    users_recommendations = recommend_users(catalog, users_profiles,
+                                            watched_matrix, 2)
+
+    rated_rows = catalog.rows_of([1, 2])
+    watched_mask = np.zeros(len(catalog), dtype=bool)
+    watched_mask[rated_rows] = True
+    user_profile = generate_user_profile(
+        catalog, rated_rows, np.array([4, 2]),
+        catalog.feature_mask(["Pitt"], [])
+    )
+
+    recommendations = remove_watcheds_and_sort_recommendations(
+        user_profile, watched_mask, catalog, 2
+    )
+
+    assert users_recommendations[0] == recommendations
+    assert users_recommendations == [([4], [0.5]), ([], []), ([], [])]
+
+
+def test_recommend_users_in_blocks_matches_whole_catalog():
+    catalog = make_catalog()
+    movie_ratings = [(10, 1, 4), (20, 3, 5), (30, 2, 1)]
+
+    users_profiles, watched_matrix = generate_users_profiles(
+        catalog, [10, 20, 30], movie_ratings, []
+    )
+    whole = recommend_users(catalog, users_profiles, watched_matrix, 2)
+    blocks = recommend_users(catalog, users_profiles, watched_matrix, 2,
+                             block_cells=1)
+
+    assert blocks == whole
+    assert [movie_ids for movie_ids, _ in whole] == [[2, 4], [], [1]]
+
+
+def test_stored_profile_roundtrip():
+    catalog = make_catalog()
+    user_profile = np.array([4, 6, 6, 0, 0, 0], dtype=float)
+
+    values = profile_values(catalog, user_profile)
+    stored_profile = {
+        "generation": "3",
+        "favorite:actor:DiCaprio": "1",
+        **{label: str(value) for label, value in values.items()}
+    }
+    parsed_profile, favorites = parse_profile(catalog, stored_profile)
+
+    assert values == {"genre:Action": 4, "genre:Drama": 6,
+                      "actor:DiCaprio": 6}
+    assert parsed_profile.tolist() == user_profile.tolist()
+    assert favorites == {"actor:DiCaprio"}
+
+
+def test_profile_of_another_catalog_generation_is_recomputed(mocker):
+    catalog = make_catalog()
+    catalog.generation = 4
+    get_profile = mocker.patch(
+        "recsys.features.users.profile.repository.get_profile",
+        return_value={"generation": "3", "genre:Action": "4.0"}
+    )
+
+    assert asyncio.run(get_user_profile(catalog, 1)) is None
+
+    get_profile.return_value = {"generation": "4", "genre:Action": "4.0"}
+    user_profile = asyncio.run(get_user_profile(catalog, 1))
+
+    assert user_profile.tolist() == [4, 0, 0, 0, 0, 0]
+
+
+def test_recomputed_profile_is_stored_against_version_read_first(mocker):
+    calls = mocker.Mock()
+    mocker.patch("recsys.features.users.application.get_catalog",
+                 return_value=make_catalog())
+    mocker.patch("recsys.features.users.profile.repository.get_profile",
+                 return_value=None)
+    calls.attach_mock(mocker.patch(
+        "recsys.features.users.repository.get_profile_version",
+        return_value="3"
+    ), "get_profile_version")
+    calls.attach_mock(mocker.patch(
+        "recsys.features.users.application.get_user_infos",
+        return_value=(np.array([1]), np.array([4]), [], [])
+    ), "get_user_infos")
+    calls.attach_mock(mocker.patch(
+        "recsys.features.users.repository.store_profile",
+        return_value=False
+    ), "store_profile")
+
+    movie_ids, _ = asyncio.run(generate_recommendation(1, 2))
+
+    assert movie_ids == [2, 4]
+    assert [call[0] for call in calls.mock_calls] == [
+        "get_profile_version", "get_user_infos", "store_profile"
+    ]
+    assert calls.store_profile.call_args.args[3] == "3"
+
+
+def test_recommendations_only_share_profile_features(mocker):
+    catalog = make_catalog()
+    user_profile = np.zeros(len(catalog.features))
+    user_profile[catalog.column(ACTOR, "Pitt")] = 5
+    watched_mask = np.array([False, True, False, False])
+
+    for candidates_share in (1, 0):
+        mocker.patch("recsys.features.users.application.CANDIDATES_SHARE",
+                     candidates_share)
+
+        recommendations = remove_watcheds_and_sort_recommendations(
+            user_profile, watched_mask, catalog, 3
+        )
+
+        assert recommendations == ([4], [1.0])
+
+
+def test_concurrent_recommendation_misses_share_one_run(mocker):
+    movies = [Movie(id=4, title="Yet another movie", genres=["Action"],
+                    actors=["Pitt"], directors=None)]
+
+    async def generate_recommendation(user_id, k):
+        await asyncio.sleep(0.01)
+        return [4], [0.5]
+
+    generate = mocker.patch(
+        "recsys.features.users.application.generate_recommendation",
+        side_effect=generate_recommendation
+    )
+    mocker.patch("recsys.features.users.repository.local_recommendations",
+                 LRUCache(maxsize=10, ttl=60))
+    mocker.patch("recsys.features.users.repository.get_recommendations",
+                 return_value=(None, False))
+    mocker.patch(
+        "recsys.features.users.application.hydrate_recommendations",
+        return_value=movies
+    )
+    mocker.patch("recsys.features.users.application.get_catalog",
+                 return_value=make_catalog())
+    mocker.patch("recsys.features.users.repository.lock_recommendations",
+                 return_value=True)
+    mocker.patch("recsys.features.users.repository.unlock_recommendations")
+    mocker.patch(
+        "recsys.features.users.repository.get_recommendations_versions",
+        return_value={1: "0"}
+    )
+    store = mocker.patch(
+        "recsys.features.users.repository.store_recommendations"
+    )
+
+    async def request_many():
+        return await asyncio.gather(
+            *(user_recommendation(1) for _ in range(3))
+        )
+
+    results = asyncio.run(request_many())
+
+    assert results == [movies] * 3
+    generate.assert_called_once_with(1, 200)
+    store.assert_called_once_with(1, [4], [0.5], "0")
+
+
+def test_stale_recommendations_are_served_while_refreshing(mocker):
+    stale = [Movie(id=4, title="Yet another movie", genres=["Action"],
+                   actors=["Pitt"], directors=None)]
+    mocker.patch("recsys.features.users.repository.local_recommendations",
+                 LRUCache(maxsize=10, ttl=60))
+    mocker.patch("recsys.features.users.repository.get_recommendations",
+                 return_value=([4], False))
+    mocker.patch("recsys.features.users.application.get_catalog",
+                 return_value=make_catalog())
+    mocker.patch(
+        "recsys.features.users.application.hydrate_recommendations",
+        return_value=stale
+    )
+    refresh = mocker.patch(
+        "recsys.features.users.application.refresh_recommendation"
+    )
+
+    async def request_and_settle():
+        recommendations = await user_recommendation(1)
+        await asyncio.sleep(0)
+        return recommendations
+
+    assert asyncio.run(request_and_settle()) == stale
+    refresh.assert_called_once_with(1)
+
+
+def test_unpack_legacy_recommendations():
+    movie_ids, scores = [4, 1, 3], [0.5, 0.25, 0.125]
+    payload = (np.array(movie_ids, dtype="<i4").tobytes()
+               + np.array(scores, dtype="<f4").tobytes())
+    legacy = json.dumps([
+        Movie(id=movie_id, title="Awesome movie", genres=["Action"],
+              actors=None, directors=None).model_dump()
+        for movie_id in movie_ids
+    ]).encode()
+
+    assert unpack_recommendations(b"\x01" + payload) == (movie_ids, scores)
+    assert unpack_recommendations(
+        b"\x02" + zlib.compress(payload)
+    ) == (movie_ids, scores)
+    assert unpack_recommendations(legacy) == (movie_ids, [])
+
+
+def test_ranked_page_keeps_stored_order_and_filters_genres(mocker):
+    # 4 and 2 tie, the lower id was ranked first and stays first
+    ranking = [1, 2, 4, 3]
+    mocker.patch("recsys.features.users.repository.get_recommendations",
+                 return_value=(ranking, True))
+    mocker.patch("recsys.features.users.application.get_catalog",
+                 return_value=make_catalog())
+
+    first = asyncio.run(ranked_page(1, (0, 2, ())))
+    second = asyncio.run(ranked_page(1, (2, 2, ())))
+    action = asyncio.run(ranked_page(1, (1, 1, ("Action",))))
+
+    assert (first, second) == (([1, 2], True), ([4, 3], True))
+    assert action == ([4], True)
+
+
+def test_local_recommendations_keep_a_few_pages_per_user(mocker):
+    local_recommendations = LRUCache(maxsize=10, ttl=60)
+    mocker.patch("recsys.features.users.repository.local_recommendations",
+                 local_recommendations)
+    mocker.patch("recsys.features.users.repository.LOCAL_CACHE_PAGES", 2)
+    mocker.patch("recsys.features.users.repository.get_recommendations",
+                 return_value=([1, 2, 4, 3], True))
+    mocker.patch("recsys.features.users.application.get_catalog",
+                 return_value=make_catalog())
+    mocker.patch(
+        "recsys.features.users.application.hydrate_recommendations",
+        side_effect=lambda movie_ids: [
+            Movie(id=movie_id, title="Awesome movie", genres=["Action"],
+                  actors=None, directors=None)
+            for movie_id in movie_ids
+        ]
+    )
+
+    async def request_pages():
+        for offset in (0, 1, 2, 10):
+            await cached_recommendation(1, (offset, 1, ()))
+
+    asyncio.run(request_pages())
+
+    assert list(local_recommendations.get(1)) == [(1, 1, ()), (2, 1, ())]
+
+
+def test_pack_recommendations_roundtrip(monkeypatch):
+    movie_ids, scores = [11, 10, 9], [0.5, 0.5, 0.5]
+
+    for compression in ("zlib", "none"):
+        monkeypatch.setenv("CACHE_COMPRESSION", compression)
+
+        assert unpack_recommendations(
+            pack_recommendations(movie_ids, scores)
+        ) == (movie_ids, scores)